@@ -0,0 +1,69 @@
+"""
+Benchmark of the reshaping of Flux records into chart data (influx.reshape_history),
+compared to the previous implementation (list scans for labels and datasets).
+Records are generated for all history ranges, with 9 measurements and gaps.
+
+Usage (from project root): python -m benchmarks.history_reshape
+Created on: 18 october 2026
+"""
+
+import random
+import timeit
+from datetime import datetime, timedelta, timezone
+
+from thingy_api.influx import RANGE_MAP, UNIT_MAP, generate_colors, generate_label, parse_duration, reshape_history
+
+
+def generate_records(time_range, window, gap_ratio=0.05):
+    """One record per measurement and aggregation window, some windows missing."""
+    window = parse_duration(window)
+    windows = parse_duration(time_range) // window
+    start = datetime(2023, 12, 1, tzinfo=timezone.utc)
+    records = []
+    for measurement in UNIT_MAP:
+        for i in range(windows):
+            if random.random() < gap_ratio:
+                continue
+            records.append({
+                "_time": start + timedelta(seconds=i * window),
+                "_measurement": measurement,
+                "_value": random.random() * 100,
+            })
+    return records
+
+
+def reshape_history_previous(records):
+    """Previous implementation, quadratic in the number of records."""
+    data = {"labels": [], "datasets": []}
+    for record in records:
+        timestamp = datetime.timestamp(record["_time"])
+        if timestamp not in data["labels"]:
+            data["labels"].append(timestamp)
+        measurement_label = generate_label(record["_measurement"])
+        dataset = next((d for d in data["datasets"] if d["label"] == measurement_label), None)
+        if not dataset:
+            dataset = {"label": measurement_label, "data": [],
+                       "borderColor": generate_colors(record["_measurement"]), "fill": False}
+            data["datasets"].append(dataset)
+        dataset["data"].append(record["_value"])
+    return data
+
+
+def main():
+    random.seed(0)
+    # Large ranges with 1m windows too, to simulate unaggregated queries
+    cases = list(RANGE_MAP.items()) + [("7d", "1m"), ("30d", "1m")]
+    print(f"{'range':>6} {'window':>6} {'records':>8} {'previous (ms)':>14} {'current (ms)':>13}")
+    for time_range, window in cases:
+        records = generate_records(time_range, window)
+        runs = 3
+        current = timeit.timeit(lambda: reshape_history(records), number=runs) / runs
+        # The previous implementation takes minutes on the largest case
+        previous = float("nan")
+        if len(records) <= 100000:
+            previous = timeit.timeit(lambda: reshape_history_previous(records), number=1)
+        print(f"{time_range:>6} {window:>6} {len(records):>8} {previous * 1000:>14.1f} {current * 1000:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
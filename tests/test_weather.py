@@ -0,0 +1,165 @@
+"""
+Offline tests of the weather refresh, against a local stub of the
+OpenWeatherMap API (run with: python -m pytest tests).
+Created on: 18 october 2026
+"""
+
+import asyncio
+import time
+
+import pytest
+from aiohttp import test_utils, web
+
+import thingy_api.weather as weather
+
+
+class WeatherStub:
+    """Stub of the OpenWeatherMap /weather endpoint. Responses can be delayed
+    or failed per latitude, and requests are recorded."""
+
+    def __init__(self):
+        self.delays = {} # Key= lat, Obj= seconds before responding
+        self.statuses = {} # Key= lat, Obj= http status
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def handle(self, request):
+        lat = float(request.query["lat"])
+        self.requests.append((lat, float(request.query["lon"])))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delays.get(lat, 0))
+        finally:
+            self.in_flight -= 1
+        status = self.statuses.get(lat, 200)
+        if status != 200:
+            return web.json_response({"message": "stub error"}, status=status)
+        return web.json_response({"coord": {"lat": lat}, "clouds": {"all": 10}})
+
+
+def plant(plant_id, lat, lng):
+    return {"id": plant_id, "thingy_id": f"thingy-{plant_id}", "lat": lat, "lng": lng}
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    """Resets the weather state and replaces its dependencies (database, mqtt)."""
+    monkeypatch.setattr(weather, "current_weather", {})
+    monkeypatch.setattr(weather, "current_light_quality", {})
+    monkeypatch.setattr(weather, "weather_stats", {**weather.weather_stats, "requests": 0, "errors": 0,
+                                                   "timeouts": 0, "cells": 0, "skipped_plants": 0})
+    monkeypatch.setattr(weather, "session", None)
+    monkeypatch.setattr(weather, "rate_limiter", weather.TokenBucket(1000, 1000))
+    monkeypatch.setattr(weather, "publish_led_color", lambda thingy_id, color: None)
+    return WeatherStub()
+
+
+def refresh(monkeypatch, stub, plants):
+    """Runs refresh_weather_info with the stub server and these plants."""
+    async def get_all_plants():
+        return plants
+    monkeypatch.setattr(weather.dal, "get_all_plants", get_all_plants)
+
+    async def run():
+        app = web.Application()
+        app.router.add_get("/weather", stub.handle)
+        server = test_utils.TestServer(app)
+        await server.start_server()
+        monkeypatch.setattr(weather, "api_url", str(server.make_url("/")))
+        try:
+            started_at = time.monotonic()
+            await weather.refresh_weather_info()
+            return time.monotonic() - started_at
+        finally:
+            await weather.close_session()
+            await server.close()
+
+    return asyncio.run(run())
+
+
+def test_cells_are_fetched_concurrently(monkeypatch, stub):
+    monkeypatch.setattr(weather, "WEATHER_CONCURRENCY", 3)
+    plants = [plant(i, 46 + i, 7) for i in range(6)]
+    stub.delays = {46 + i: 0.2 for i in range(6)}
+
+    elapsed = refresh(monkeypatch, stub, plants)
+
+    assert stub.max_in_flight == 3
+    assert elapsed < 6 * 0.2 # Sequential fetches would take 1.2s
+    assert set(weather.current_weather) == set(range(6))
+    assert weather.weather_stats["requests"] == 6
+
+
+def test_plants_in_the_same_cell_share_a_request(monkeypatch, stub):
+    plants = [plant(1, 46.5201, 6.6301), plant(2, 46.5204, 6.6298), plant(3, 47.37, 8.54)]
+
+    refresh(monkeypatch, stub, plants)
+
+    assert len(stub.requests) == 2
+    assert weather.current_weather[1] is weather.current_weather[2]
+    assert weather.weather_stats["cells"] == 2
+
+
+def test_timeout_does_not_block_other_cells(monkeypatch, stub):
+    monkeypatch.setattr(weather, "WEATHER_TIMEOUT", 0.2)
+    plants = [plant(1, 46, 7), plant(2, 47, 7)]
+    stub.delays = {46: 2}
+
+    elapsed = refresh(monkeypatch, stub, plants)
+
+    assert elapsed < 2
+    assert weather.weather_stats["timeouts"] == 1
+    assert 1 not in weather.current_weather
+    assert weather.current_weather[2]["coord"]["lat"] == 47
+
+
+def test_failing_plant_keeps_its_previous_weather(monkeypatch, stub):
+    previous = {"coord": {"lat": 46}, "clouds": {"all": 90}}
+    weather.current_weather[1] = previous
+    plants = [plant(1, 46, 7), plant(2, 47, 7)]
+    stub.statuses = {46: 500}
+
+    refresh(monkeypatch, stub, plants)
+
+    assert weather.current_weather[1] is previous
+    assert weather.current_light_quality[1] == 4
+    assert weather.current_weather[2]["coord"]["lat"] == 47
+    assert weather.weather_stats["errors"] == 1
+
+
+def test_plants_without_coordinates_are_skipped(monkeypatch, stub):
+    plants = [plant(1, None, 7), plant(2, 47, 7)]
+
+    refresh(monkeypatch, stub, plants)
+
+    assert stub.requests == [(47, 7)]
+    assert weather.weather_stats["skipped_plants"] == 1
+
+
+def test_database_error_keeps_previous_weather(monkeypatch, stub):
+    previous = {"coord": {"lat": 46}, "clouds": {"all": 90}}
+    weather.current_weather[1] = previous
+
+    refresh(monkeypatch, stub, {"message": "error when retrieving plants."})
+
+    assert stub.requests == []
+    assert weather.current_weather[1] is previous
+
+
+def test_token_bucket_paces_requests_after_a_burst():
+    async def run():
+        bucket = weather.TokenBucket(rate=20, capacity=2)
+        started_at = time.monotonic()
+        times = []
+        for _ in range(6):
+            await bucket.acquire()
+            times.append(time.monotonic() - started_at)
+        return times
+
+    times = asyncio.run(run())
+
+    assert times[1] < 0.05 # Burst of capacity requests
+    # Then rate requests per second: request n waits for n - capacity tokens
+    assert all(times[n] >= (n + 1 - 2) / 20 * 0.9 for n in range(2, 6))
@@ -5,7 +5,9 @@ Updated by: LK on 20 dec 2023
 """
 
 import asyncio
+import json
 import logging
+import re
 from logging.handlers import RotatingFileHandler
 from os import getenv
 
@@ -13,16 +15,20 @@ import aiohttp_cors
 from aiohttp import web
 from dotenv import load_dotenv
 
-from thingy_api.influx import get_plant_simple_history
-from thingy_api.middleware import keycloak_middleware
-import thingy_api.dal.plant as plant_dal
-import thingy_api.dal.user as user_dal
-import thingy_api.dal.thingy_id as thingy_id_dal
-import thingy_api.dal.maintenance as maintenance_dal
-from thingy_api.thingy_mqtt import start_mqtt
-from thingy_api.thingy_mqtt import get_thingy_data
-from thingy_api.thingy_mqtt import start_mqtt, get_thingy_data, get_thingy_id_data
+from thingy_api.cache import ResponseCache, SnapshotCache
+from thingy_api.influx import (HISTORY_BATCH_MAX_IDS, HISTORY_POINTS, align_start, close_query_client,
+                               get_plant_simple_history, get_plants_history, get_query_stats, history_window,
+                               parse_time, range_window, rollups as influx_rollups, spool as influx_spool,
+                               stream_plant_history, window_ttl, writer as influx_writer)
+from thingy_api.live import hub as live_hub
+from thingy_api.middleware import KEYS_REFRESH_INTERVAL, get_token_cache_stats, keycloak_middleware, refresh_realm_keys
+import thingy_api.dal.aio as async_dal # Not "dal": would replace the thingy_api.dal package attribute
+from thingy_api.dal.pool import get_pool_stats, pool
+from thingy_api.thingy_registry import LAST_SEEN_FLUSH_INTERVAL, flush_last_seen, load_registry
+from thingy_api.thingy_mqtt import (start_mqtt, get_thingy_data, get_thingy_data_json, get_thingy_id_data, get_ingest_stats,
+                                    get_backup_stats, get_latest_stats, stop_mqtt)
 from thingy_api.weather import add_light_quality_to_plants, get_current_light_quality, refresh_weather_info, get_current_station_weather
+from thingy_api.weather import close_session as close_weather_session, get_light_quality_version, get_weather_stats
 
 # take environment variables from api.env
 load_dotenv(dotenv_path='environments/api.env')
@@ -31,6 +37,17 @@ load_dotenv(dotenv_path='environments/api.env')
 IP = getenv('API_IP', 'localhost')
 PORT = getenv('API_PORT', '8000')
 
+# Cache of /api/influx responses, key= (thingy_id, range) or (thingy_id, start window, stop, window),
+# prefixed with "batch" and the sorted ids tuple for /api/influx/batch
+history_cache = ResponseCache(max_bytes=int(getenv('HISTORY_CACHE_MAX_BYTES', str(64 * 1024 * 1024))))
+# Thingy ids accepted by history routes, which write them in Flux queries
+THINGY_ID_PATTERN = re.compile(r"[\w.:-]+")
+
+# Serialized /api/plants and /api/map/plants responses, reloaded after plant writes,
+# light quality changes, or PLANTS_CACHE_TTL seconds (database changed outside of the API)
+plants_cache = SnapshotCache(ttl=float(getenv('PLANTS_CACHE_TTL', "60")))
+plants_map_cache = SnapshotCache(ttl=float(getenv('PLANTS_CACHE_TTL', "60")))
+
 # setup logs
 logging.basicConfig(
     level=logging.INFO,  # Set the logging level as needed (e.g., INFO, DEBUG, ERROR)
@@ -48,30 +65,76 @@ logging.getLogger().addHandler(log_handler)
 
 
 async def main():
+    # Open database connections in advance
+    await async_dal.run(pool.open)
+    # Load known thingy ids before receiving MQTT messages
+    await async_dal.run(load_registry)
     # Start the MQTT client
+    # Live data is pushed to websocket clients from MQTT workers
+    live_hub.start(asyncio.get_running_loop())
     start_mqtt()
     # Reset maintenance status
-    maintenance_dal.reset_maintenance_status()
+    await async_dal.reset_maintenance_status()
+
+    # Create Influxdb rollup buckets and tasks (backfilled in the background)
+    if influx_rollups is not None:
+        await asyncio.get_running_loop().run_in_executor(None, influx_rollups.provision)
+
+    # Load Keycloak realm keys, tokens are then verified locally
+    await refresh_realm_keys()
+    asyncio.create_task(schedule_task(refresh_realm_keys, interval_seconds=KEYS_REFRESH_INTERVAL))
 
     # Get initial light quality 
     await refresh_weather_info()
     # Schedule get_light_quality() every 2 minutes
     asyncio.create_task(schedule_task(refresh_weather_info, interval_seconds=120))
 
+    # Write thingy last seen timestamps periodically
+    asyncio.create_task(schedule_task(flush_last_seen_task, interval_seconds=LAST_SEEN_FLUSH_INTERVAL))
+    # Close idle database connections, also when no request uses the pool
+    asyncio.create_task(schedule_task(reap_pool_task, interval_seconds=pool.idle_timeout))
+
     # Initialize the aiohttp app
     return init_app()
 
 
+async def cleanup(app):
+    """Releases shared resources when the server stops."""
+    stop_mqtt()
+    await live_hub.close()
+    influx_writer.close()
+    await close_query_client()
+    await close_weather_session()
+    await flush_last_seen_task()
+    async_dal.executor.shutdown(wait=True)
+    pool.closeall()
+
+
+async def flush_last_seen_task():
+    """Flushes thingy last seen timestamps without blocking the event loop."""
+    await async_dal.run(flush_last_seen)
+
+
+async def reap_pool_task():
+    """Closes idle database connections without blocking the event loop."""
+    await async_dal.run(pool.reap)
+
+
 async def schedule_task(task_function, interval_seconds):
-    """Custom method to run scheduled tasks."""
+    """Custom method to run scheduled tasks.
+    Errors are logged: the task runs again at the next interval."""
     while True:
         await asyncio.sleep(interval_seconds)
-        await task_function()
+        try:
+            await task_function()
+        except Exception as e:
+            logging.error(f"Scheduled task {task_function.__name__} failed: {e}")
 
 
 def init_app():
     # Create app, also including credential checker middleware
     app = web.Application(middlewares=[keycloak_middleware])
+    app.on_cleanup.append(cleanup)
 
     # Configure default CORS settings.
     # TODO: modify according to the frontend url (if it should not be accessed somewhere else)
@@ -86,13 +149,18 @@ def init_app():
 
     # TODO: add all routes here
     cors.add(app.router.add_get('/api/test', test_route, name='test'))
+    cors.add(app.router.add_get('/api/monitoring', get_monitoring_stats, name='get_monitoring_stats'))
 
     # Historical data actions
+    # Before /api/influx/{id}, which would match "batch"
+    cors.add(app.router.add_get('/api/influx/batch', influx_get_batch, name='influx_get_batch'))
+    cors.add(app.router.add_get('/api/influx/{id}', influx_get_span_for, name='influx_get_span_for'))
     cors.add(app.router.add_get('/api/influx/{id}/{range}', influx_get_for, name='influx_get_for'))
 
     # currrent data actions
     cors.add(app.router.add_get('/api/thingy', thingy_data_get, name='thingy_get'))
     cors.add(app.router.add_get('/api/thingy/{id}', thingy_data_by_id_get, name='thingy_by_id_get'))
+    cors.add(app.router.add_get('/api/live', live_data_ws, name='live_data_ws'))
 
     # thingy actions
     cors.add(app.router.add_get('/api/thingy_id', get_all_thingy_ids, name='get_all_thingy_ids'))
@@ -123,31 +191,176 @@ async def test_route(request):
     """Hello world route, to make sure that api is working"""
     return web.json_response({"message": "Hello world!"})
 
+
+async def get_monitoring_stats(request):
+    """Route to get internal caches and pools statistics."""
+    return web.json_response({
+        "token_cache": get_token_cache_stats(),
+        "db_pool": get_pool_stats(),
+        "mqtt_ingest": get_ingest_stats(),
+        "backup_writer": get_backup_stats(),
+        "latest_data": get_latest_stats(),
+        "influx_writer": influx_writer.stats(),
+        "influx_spool": influx_spool.stats() if influx_spool is not None else None,
+        "influx_queries": get_query_stats(),
+        "influx_rollups": influx_rollups.stats() if influx_rollups is not None else None,
+        "history_cache": history_cache.stats(),
+        "live": live_hub.stats(),
+        "plants_cache": plants_cache.stats(),
+        "plants_map_cache": plants_map_cache.stats(),
+        "weather": get_weather_stats(),
+    })
+
+
+def json_etag_response(request, etag, body):
+    """Returns a JSON body with its ETag, or 304 if the client sent this ETag in If-None-Match."""
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match:
+        client_etags = {value.strip().removeprefix("W/") for value in if_none_match.split(",")}
+        if etag in client_etags or "*" in client_etags:
+            return web.Response(status=304, headers={"ETag": etag})
+    return web.Response(body=body, content_type="application/json", headers={"ETag": etag})
+
+
 ########################################
 # INFLUX ROUTES
 
 async def influx_get_for(request):
-    """Route to get influx data for thingy ID"""
+    """Route to get influx data for thingy ID.
+    With ?stream=1, the history is streamed as {x, y} points (see stream_plant_history)."""
     thingy_id = request.match_info.get('id')
     range = request.match_info.get('range')
+    if not THINGY_ID_PATTERN.fullmatch(thingy_id):
+        # Ids are written in the Flux query
+        return web.Response(status=400, text="Invalid thingy id")
     # Check if range is in accepted format
     if range not in ["30d", "15d", "7d", "1d", "1h"]: 
         return web.Response(status=404, text="Time range not allowed")
-    result = get_plant_simple_history(thingy_id, range)
-    if result is not None:
-        return web.json_response(result)
+
+    window, start = range_window(range)
+    # Same thingy and range share the result until the aggregation window changes
+    return await history_response(request, (thingy_id, range), thingy_id, window, start)
+
+
+async def influx_get_span_for(request):
+    """Route to get influx data for thingy ID between ?start= and ?stop= (unix
+    timestamps or ISO 8601 dates, stop defaults to now), aggregated so that each
+    series has at most about ?points= values. Also accepts ?stream=1."""
+    thingy_id = request.match_info.get('id')
+    if not THINGY_ID_PATTERN.fullmatch(thingy_id):
+        return web.Response(status=400, text="Invalid thingy id")
+    try:
+        window, start, stop = span_params(request)
+    except ValueError as e:
+        return web.Response(status=400, text=str(e))
+
+    # Start is aligned on the window, so that close requests share the cached result
+    key = (thingy_id, int(start) // window, stop, window)
+    return await history_response(request, key, thingy_id, window, start, stop)
+
+
+async def influx_get_batch(request):
+    """Route to get influx data of several thingys with a single query.
+    Thingy ids are given with ?ids=orange-1,orange-2 (or repeated), and the
+    period with ?range= (same ranges as influx_get_for) or ?start=&stop=&points=.
+    Returns {thingy_id: history}, histories shaped like influx_get_for."""
+    thingy_ids = sorted({thingy_id for value in request.query.getall("ids", [])
+                         for thingy_id in value.split(",") if thingy_id})
+    if not thingy_ids:
+        return web.Response(status=400, text="ids is required")
+    if len(thingy_ids) > HISTORY_BATCH_MAX_IDS:
+        return web.Response(status=400, text=f"At most {HISTORY_BATCH_MAX_IDS} ids are allowed")
+    if not all(THINGY_ID_PATTERN.fullmatch(thingy_id) for thingy_id in thingy_ids):
+        # Ids are written in the Flux query
+        return web.Response(status=400, text="Invalid thingy id")
+
+    if "range" in request.query:
+        range = request.query["range"]
+        if range not in ["30d", "15d", "7d", "1d", "1h"]:
+            return web.Response(status=404, text="Time range not allowed")
+        window, start = range_window(range)
+        stop = None
+        key = ("batch", tuple(thingy_ids), range)
+    else:
+        try:
+            window, start, stop = span_params(request)
+        except ValueError as e:
+            return web.Response(status=400, text=str(e))
+        key = ("batch", tuple(thingy_ids), int(start) // window, stop, window)
+
+    async def load():
+        return json.dumps(await get_plants_history(thingy_ids, window, start, stop)).encode()
+
+    try:
+        body = await history_cache.get_or_load(key, load, ttl=window_ttl(window))
+    except asyncio.TimeoutError:
+        return web.Response(status=504, text="Influxdb query timed out")
+    return web.Response(body=body, content_type="application/json")
+
+
+def span_params(request):
+    """Returns the window, start and stop of ?start=&stop=&points= parameters.
+    Raises ValueError if they are missing, invalid or too expensive."""
+    if "start" not in request.query:
+        raise ValueError("start is required")
+    start = parse_time(request.query["start"])
+    stop = parse_time(request.query["stop"]) if "stop" in request.query else None
+    points = int(request.query.get("points", HISTORY_POINTS))
+    window = history_window(start, stop, points)
+    return window, align_start(start, window), stop
+
+
+async def history_response(request, cache_key, thingy_id, window, start, stop=None):
+    """Returns the history of a thingy, from the cache or streamed (?stream=1)."""
+    if request.query.get("stream") in ("1", "true"):
+        return await influx_stream_for(request, thingy_id, window, start, stop)
+
+    async def load():
+        result = await get_plant_simple_history(thingy_id, window, start, stop)
+        return json.dumps(result).encode() if result is not None else None
+
+    # If the client disconnects, aiohttp cancels this handler and the query with it.
+    try:
+        body = await history_cache.get_or_load(cache_key, load, ttl=window_ttl(window))
+    except asyncio.TimeoutError:
+        return web.Response(status=504, text="Influxdb query timed out")
+    if body is not None:
+        return web.Response(body=body, content_type="application/json")
     else:
         # Case in which requested ID does not exist
         return web.Response(status=404, text="Thingy not found")
 
+
+async def influx_stream_for(request, thingy_id, window, start, stop=None):
+    """Writes the history of a thingy in chunks, as records are received from Influxdb."""
+    chunks = stream_plant_history(thingy_id, window, start, stop)
+    try:
+        try:
+            # The query starts with the first chunk, so errors can still change the status
+            first_chunk = await chunks.__anext__()
+        except asyncio.TimeoutError:
+            return web.Response(status=504, text="Influxdb query timed out")
+
+        response = web.StreamResponse(headers={"Content-Type": "application/json"})
+        await response.prepare(request)
+        await response.write(first_chunk)
+        async for chunk in chunks:
+            await response.write(chunk)
+        await response.write_eof()
+        return response
+    finally:
+        # Stops the Influxdb query if the client disconnected
+        await chunks.aclose()
+
+
 ########################################
 # THINGY ROUTES
 
 # get request without automatic update in FE 
 async def thingy_data_get(request):
-    """Route to get thingy data"""
-    result = get_thingy_data()
-    return web.json_response(result)
+    """Route to get thingy data. Returns 304 if unchanged since the client's ETag."""
+    etag, body = get_thingy_data_json()
+    return json_etag_response(request, etag, body)
 
 async def thingy_data_by_id_get(request):
     """Route to get thingy data for ID"""
@@ -161,9 +374,14 @@ async def thingy_data_by_id_get(request):
         return web.Response(status=404, text="Thingy not found")
 
 
+async def live_data_ws(request):
+    """Websocket pushing thingy data changes, replaces polling of /api/thingy (see live.py)."""
+    return await live_hub.handle(request, get_thingy_data)
+
+
 async def get_all_thingy_ids(request):
     """Route to get thingy Ids only"""
-    result = thingy_id_dal.get_all_thingy_ids()
+    result = await async_dal.get_all_thingy_ids()
     return web.json_response(result)
 
 ########################################
@@ -174,12 +392,14 @@ async def create_plant(request):
     """Route to create a new plant. Takes a json object as request 
        with all plant details."""
     data = await request.json()
-    result = plant_dal.create_plant(data)
+    result = await async_dal.create_plant(data)
+    invalidate_plants()
     return web.json_response(result)
 
 
 async def create_plant_dev(request):
     """DEV function: Creates two placeholder plants for tests."""
+    contact_person = (await async_dal.get_user_dev())["id"]
     plant_data_1 = {
         'friendly_name': 'Bundeshaus Energie',
         'thingy_id': 'orange-1',
@@ -189,7 +409,7 @@ async def create_plant_dev(request):
         'lng': 7.444104,
         'max_power': 2500,
         'nr_panels': 200,
-        'contact_person': user_dal.get_user_dev()["id"]
+        'contact_person': contact_person
     }
     plant_data_2 = {
         'friendly_name': 'Romande Energie',
@@ -200,22 +420,36 @@ async def create_plant_dev(request):
         'lng': 6.498429,
         'max_power': 1000,
         'nr_panels': 50,
-        'contact_person': user_dal.get_user_dev()["id"]
+        'contact_person': contact_person
     }
-    plant_dal.create_plant(plant_data_1)
-    result = plant_dal.create_plant(plant_data_2)
+    await async_dal.create_plant(plant_data_1)
+    result = await async_dal.create_plant(plant_data_2)
+    invalidate_plants()
     return web.json_response(result)
 
 
 async def get_all_plants(request):
-    """Route to get all plants."""
-    return web.json_response(plant_dal.get_all_plants())
+    """Route to get all plants. Returns 304 if unchanged since the client's ETag."""
+    try:
+        etag, body = await plants_cache.get(load_plants)
+    except ValueError as e:
+        return web.json_response({"message": str(e)}, status=500)
+    return json_etag_response(request, etag, body)
+
+
+async def load_plants():
+    """Returns all plants. Raises ValueError on database errors, so that
+    the error is not cached (the DAL returns an error dict)."""
+    plants = await async_dal.get_all_plants()
+    if not isinstance(plants, list):
+        raise ValueError(plants.get("message", "error when retrieving plants."))
+    return plants
 
 
 async def get_plant(request):
     """Route to get one plant by id."""
     id = str(request.match_info['id'])
-    result = plant_dal.get_plant(id)
+    result = await async_dal.get_plant(id)
     return web.json_response(result)
 
 
@@ -223,23 +457,36 @@ async def update_plant(request):
     """Route to update a plant by id"""
     id = str(request.match_info['id'])
     data = await request.json()
-    result = plant_dal.update_plant(id, data)
+    result = await async_dal.update_plant(id, data)
+    invalidate_plants()
     return web.json_response(result)
 
 
 async def delete_plant(request):
     """Route to delete a plant by id"""
     id = str(request.match_info['id'])
-    result = plant_dal.delete_plant(id)
+    result = await async_dal.delete_plant(id)
+    invalidate_plants()
     return web.json_response(result)
 
 
 async def get_all_plants_map(request):
     """Route to get information to print on a map. 
     It adds cloud cover information to show on plant popups."""
-    plants = plant_dal.get_all_plants()
-    plants_final = add_light_quality_to_plants(plants)
-    return web.json_response(plants_final)
+    async def load():
+        return add_light_quality_to_plants(await load_plants())
+
+    try:
+        etag, body = await plants_map_cache.get(load, version=get_light_quality_version())
+    except ValueError as e:
+        return web.json_response({"message": str(e)}, status=500)
+    return json_etag_response(request, etag, body)
+
+
+def invalidate_plants():
+    """Plants changed: cached plant lists must be reloaded."""
+    plants_cache.invalidate()
+    plants_map_cache.invalidate()
 
 
 async def get_plant_light_quality(request):
@@ -261,13 +508,13 @@ async def get_weather_plant(request):
 async def get_plant_maintenance(request):
     """Route to get the status of a plant maintenance by id."""
     id = str(request.match_info['id'])
-    result = maintenance_dal.get_maintenance_status(id)
+    result = await async_dal.get_maintenance_status(id)
     return web.json_response(result)
 
 async def get_maintenance_history(request):
     """Route to get history of plant maintenances by plant id."""
     id = str(request.match_info['id'])
-    result = maintenance_dal.get_maintenance_history(id)
+    result = await async_dal.get_maintenance_history(id)
     return web.json_response(result)
 
 ###########################################
@@ -275,5 +522,5 @@ async def get_maintenance_history(request):
 
 async def get_all_users(request):
     """Route to get all users from Keycloak database table."""
-    result = user_dal.get_all_users()
+    result = await async_dal.get_all_users()
     return web.json_response(result)
@@ -0,0 +1,262 @@
+"""
+Compressed archive of thingy backup files, and replay to Influxdb.
+
+Day files data/{thingy_id}/{yyyymmdd}.txt (one JSON message per line) are
+compacted into data/{thingy_id}/{yyyymmdd}.tba files:
+- "TBA1" magic
+- blocks: zlib compressed JSON, one block per appId (max BLOCK_ROWS rows),
+  with one list per message field (columnar), sorted by message "ts"
+- index: zlib compressed JSON {"blocks": list of blocks (appId, offset,
+  length, rows, min_ts, max_ts), "text_bytes": bytes of the text file already
+  archived}, so that replays only read relevant blocks and compactions of kept
+  text files (--keep-text) only add new lines. Older archives have a list.
+- footer: index offset (8 bytes, little endian) and "TBA1" magic
+
+Usage:
+    python -m thingy_api.archive compact [--keep-text]
+    python -m thingy_api.archive replay --start 2023-12-01 --end 2023-12-10 [--thingy orange-1]
+Created on: 18 october 2026
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import struct
+import sys
+import time
+import zlib
+from datetime import datetime, timedelta
+
+MAGIC = b"TBA1"
+FOOTER = struct.Struct("<Q")
+BLOCK_ROWS = 10000
+ARCHIVE_SUFFIX = ".tba"
+TEXT_SUFFIX = ".txt"
+# Influxdb spool of replays (in the data folder), separate from the API spool.
+REPLAY_SPOOL_DIR = ".influx_spool_replay"
+# Lines that are not valid JSON messages are kept in this pseudo appId.
+RAW_APP_ID = "_raw"
+
+
+def write_archive(path, messages, text_bytes=0):
+    """Writes messages (dicts) to an archive file. Returns the number of rows.
+    :param text_bytes: size of the text file archived, if it is kept."""
+    by_app = {}
+    for message in messages:
+        by_app.setdefault(message.get("appId", RAW_APP_ID), []).append(message)
+
+    index = []
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(MAGIC)
+        for app_id, app_messages in sorted(by_app.items()):
+            app_messages.sort(key=lambda message: message.get("ts") or 0)
+            for start in range(0, len(app_messages), BLOCK_ROWS):
+                rows = app_messages[start:start + BLOCK_ROWS]
+                fields = sorted({field for row in rows for field in row})
+                columns = {field: [row.get(field) for row in rows] for field in fields}
+                block = zlib.compress(json.dumps(columns).encode(), 9)
+                timestamps = [ts for ts in columns.get("ts", []) if isinstance(ts, (int, float))]
+                index.append({
+                    "appId": app_id,
+                    "offset": file.tell(),
+                    "length": len(block),
+                    "rows": len(rows),
+                    "min_ts": min(timestamps) if timestamps else None,
+                    "max_ts": max(timestamps) if timestamps else None,
+                })
+                file.write(block)
+        index_offset = file.tell()
+        file.write(zlib.compress(json.dumps({"blocks": index, "text_bytes": text_bytes}).encode()))
+        file.write(FOOTER.pack(index_offset) + MAGIC)
+    os.replace(tmp_path, path)
+    return sum(entry["rows"] for entry in index)
+
+
+def read_index(file):
+    """Returns the index of an opened archive file: {"blocks": [...], "text_bytes": int}."""
+    file.seek(-(FOOTER.size + len(MAGIC)), os.SEEK_END)
+    footer = file.read(FOOTER.size + len(MAGIC))
+    if footer[FOOTER.size:] != MAGIC:
+        raise ValueError(f"{file.name} is not a thingy backup archive")
+    index_offset = FOOTER.unpack(footer[:FOOTER.size])[0]
+    file.seek(index_offset)
+    end = os.fstat(file.fileno()).st_size - FOOTER.size - len(MAGIC)
+    index = json.loads(zlib.decompress(file.read(end - index_offset)))
+    if isinstance(index, list):
+        index = {"blocks": index, "text_bytes": 0} # Older archives
+    return index
+
+
+def read_archive(path, app_ids=None, start_ts=None, end_ts=None):
+    """Yields messages (dicts) of an archive, block by block.
+    Blocks of other appIds, or outside [start_ts, end_ts] (ms), are skipped."""
+    with open(path, "rb") as file:
+        for entry in read_index(file)["blocks"]:
+            if app_ids is not None and entry["appId"] not in app_ids:
+                continue
+            if start_ts is not None and entry["max_ts"] is not None and entry["max_ts"] < start_ts:
+                continue
+            if end_ts is not None and entry["min_ts"] is not None and entry["min_ts"] > end_ts:
+                continue
+            file.seek(entry["offset"])
+            columns = json.loads(zlib.decompress(file.read(entry["length"])))
+            fields = list(columns)
+            for values in zip(*(columns[field] for field in fields)):
+                yield {field: value for field, value in zip(fields, values) if value is not None}
+
+
+def read_text(path, skip_partial=False, offset=0):
+    """Yields messages (dicts) of a backup day file, from a byte offset.
+    With skip_partial, a last line without newline (still being written) is skipped."""
+    with open(path, "rb") as file:
+        file.seek(offset)
+        for line in file:
+            if skip_partial and not line.endswith(b"\n"):
+                return
+            line = line.decode(errors="replace").strip()
+            if not line:
+                continue
+            try:
+                message = json.loads(line)
+            except ValueError:
+                message = None
+            if not isinstance(message, dict):
+                message = {"appId": RAW_APP_ID, "raw": line}
+            yield message
+
+
+def day_files(data_dir, thingy_ids=None):
+    """Yields (thingy_id, day, path) of all backup files (text and archives)."""
+    for thingy_id in sorted(os.listdir(data_dir)):
+        thingy_dir = os.path.join(data_dir, thingy_id)
+        if thingy_id.startswith(".") or not os.path.isdir(thingy_dir):
+            continue # Spool folders, .gitkeep
+        if thingy_ids and thingy_id not in thingy_ids:
+            continue
+        for name in sorted(os.listdir(thingy_dir)):
+            day, suffix = os.path.splitext(name)
+            if suffix in (TEXT_SUFFIX, ARCHIVE_SUFFIX) and day.isdigit():
+                yield thingy_id, day, os.path.join(thingy_dir, name)
+
+
+def read_day_file(path, app_ids=None, start_ts=None, end_ts=None, skip_partial=False):
+    """Yields messages (dicts) of a day file, archive or text.
+    Filters only skip archive blocks: see data_messages."""
+    if path.endswith(ARCHIVE_SUFFIX):
+        return read_archive(path, app_ids, start_ts, end_ts)
+    return read_text(path, skip_partial)
+
+
+def data_messages(messages, app_ids, start_ts=None, end_ts=None, skip=0):
+    """Yields (position, message, timestamp) of the messages to write to
+    Influxdb: messages of app_ids with a "ts" in [start_ts, end_ts] (ms).
+    position counts messages read, including the skip first ones (resume of
+    an interrupted import), timestamp is "ts" in nanoseconds."""
+    for position, message in enumerate(itertools.islice(messages, skip, None), skip + 1):
+        ts = message.get("ts")
+        if message.get("appId") not in app_ids or not isinstance(ts, (int, float)):
+            continue
+        if (start_ts is not None and ts < start_ts) or (end_ts is not None and ts > end_ts):
+            continue
+        yield position, message, int(ts) * 1000000
+
+
+def compact(data_dir, keep_text=False):
+    """Compacts all day files older than today into archives."""
+    today = datetime.now().strftime('%Y%m%d')
+    for thingy_id, day, path in day_files(data_dir):
+        if not path.endswith(TEXT_SUFFIX) or day >= today:
+            continue # Today's file is still being written
+        archive_path = path[:-len(TEXT_SUFFIX)] + ARCHIVE_SUFFIX
+        # Day files older than today are not written anymore
+        text_bytes = os.path.getsize(path)
+        if os.path.exists(archive_path):
+            # Lines of the text file not archived yet: all lines if the text file
+            # was removed after the previous compaction (late messages)
+            with open(archive_path, "rb") as file:
+                offset = read_index(file)["text_bytes"]
+            if offset > text_bytes:
+                offset = 0 # Text file replaced since
+            if offset == text_bytes and keep_text:
+                continue # Already compacted
+            messages = list(read_archive(archive_path)) + list(read_text(path, offset=offset))
+        else:
+            messages = list(read_text(path))
+        rows = write_archive(archive_path, messages, text_bytes if keep_text else 0)
+
+        # Check the archive before removing the text file
+        if sum(1 for _ in read_archive(archive_path)) != rows or rows != len(messages):
+            logging.error(f"Archive check failed for {archive_path}, text file kept.")
+            continue
+        if not keep_text:
+            os.remove(path)
+        print(f"{thingy_id} {day}: {rows} messages, "
+              f"{os.path.getsize(archive_path)} bytes")
+
+
+def replay(data_dir, start, end, thingy_ids=None, batch_size=None):
+    """Writes backed up messages between start and end (dates, included)
+    to Influxdb, like messages received from MQTT, with their original "ts".
+    Same pipeline as the bulk importer (backfill.py), through the batching writer."""
+    # Imported here: only needed for replays
+    from thingy_api.influx import write_point, writer
+    from thingy_api.influx_spool import Spool
+    from thingy_api.thingy_mqtt import INFLUX_DATA_IDS
+
+    if batch_size:
+        writer.batch_size = batch_size
+    if writer.spool is not None:
+        # Not the spool of the running API: both writers would replay the same segments
+        writer.spool = Spool(os.path.join(data_dir, REPLAY_SPOOL_DIR), max_bytes=writer.spool.max_bytes)
+    start_ts = int(start.timestamp() * 1000)
+    end_ts = int((end + timedelta(days=1)).timestamp() * 1000) - 1
+    first_day, last_day = start.strftime('%Y%m%d'), end.strftime('%Y%m%d')
+    app_ids = set(INFLUX_DATA_IDS)
+
+    count = 0
+    started_at = time.monotonic()
+    for thingy_id, day, path in day_files(data_dir, thingy_ids):
+        # A day can have both an archive and a text file (late messages)
+        if not first_day <= day <= last_day:
+            continue
+        messages = read_day_file(path, app_ids, start_ts, end_ts)
+        for _, message, timestamp in data_messages(messages, app_ids, start_ts, end_ts):
+            # Invalid messages are logged and skipped by write_point
+            write_point(message.get("data"), message["appId"], thingy_id, timestamp=timestamp, block=True)
+            count += 1
+        print(f"{thingy_id} {day}: {count} messages queued "
+              f"({count / (time.monotonic() - started_at):.0f} messages/s)")
+
+    writer.close(timeout=None)
+    print(f"Done: {writer.stats()}")
+    if writer.spool is not None and not writer.spool.is_empty():
+        print(f"Some points could not be written, they are kept in {writer.spool.directory} "
+              f"and written by the next replay.")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Thingy backup archives.")
+    parser.add_argument("--data-dir", default="data")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    compact_parser = commands.add_parser("compact", help="compact day files older than today")
+    compact_parser.add_argument("--keep-text", action="store_true", help="don't remove text files")
+
+    replay_parser = commands.add_parser("replay", help="write a date range to Influxdb")
+    replay_parser.add_argument("--start", required=True, type=datetime.fromisoformat, help="e.g., 2023-12-01")
+    replay_parser.add_argument("--end", required=True, type=datetime.fromisoformat, help="included")
+    replay_parser.add_argument("--thingy", action="append", help="thingy id (repeatable), default all")
+    replay_parser.add_argument("--batch-size", type=int, help="records per Influxdb write")
+
+    args = parser.parse_args(argv)
+    if args.command == "compact":
+        compact(args.data_dir, args.keep_text)
+    else:
+        replay(args.data_dir, args.start, args.end, args.thingy, args.batch_size)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
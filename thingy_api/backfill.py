@@ -0,0 +1,229 @@
+"""
+Bulk import of backup day files (data/{thingy_id}/{yyyymmdd}.txt, and .tba
+archives of compacted days, see archive.py) into Influxdb.
+Files are streamed through the same pipeline as archive replays
+(read_day_file, data_messages), converted to line protocol with the original
+message "ts", and written in large batches, one thread per thingy.
+Progress (messages read per file) is saved in a checkpoint file, so that an
+interrupted import resumes where it stopped.
+
+Usage:
+    python -m thingy_api.backfill [--thingy orange-1] [--start 2023-12-01] [--end 2023-12-10]
+Created on: 18 october 2026
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from influxdb_client.client.write_api import SYNCHRONOUS
+
+from thingy_api.archive import ARCHIVE_SUFFIX, data_messages, day_files, read_day_file
+from thingy_api.influx import bucket, build_records, client, org
+from thingy_api.thingy_mqtt import INFLUX_DATA_IDS
+
+MAX_RETRIES = 5
+
+
+class Checkpoint:
+    """Number of messages already imported for each file, saved as JSON.
+
+    Positions are only valid for the file content they were read from: text
+    files are only appended to, but archives are rewritten (and re-sorted) by
+    compactions. Each position is saved with the file size and modification
+    time, and a file that changed since (archive) or shrank (text file
+    replaced) is imported again from the start. Points written twice are
+    overwritten by Influxdb."""
+
+    def __init__(self, path, save_interval=5.0):
+        self.path = path
+        self.save_interval = save_interval
+        self.positions = {} # Key= file path, Obj= [position, size, mtime_ns]
+        self._lock = threading.Lock()
+        self._last_save = 0.0
+        if os.path.exists(path):
+            with open(path) as file:
+                # Older checkpoints (byte offsets, positions without file state) are ignored
+                self.positions = {file_path: value for file_path, value in json.load(file).get("messages", {}).items()
+                                  if isinstance(value, list)}
+
+    def get(self, file_path):
+        with self._lock:
+            entry = self.positions.get(file_path)
+        if entry is None:
+            return 0
+        position, size, mtime_ns = entry
+        stat = os.stat(file_path)
+        if file_path.endswith(ARCHIVE_SUFFIX):
+            changed = (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns)
+        else:
+            changed = stat.st_size < size
+        if changed:
+            logging.info(f"{file_path} changed since the last backfill, imported again.")
+            return 0
+        return position
+
+    def set(self, file_path, position, stat):
+        """:param stat: os.stat of the file taken before reading it (compactions
+        replace archives while they are read)."""
+        with self._lock:
+            self.positions[file_path] = [position, stat.st_size, stat.st_mtime_ns]
+            if time.monotonic() - self._last_save >= self.save_interval:
+                self._save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump({"messages": self.positions}, file)
+        os.replace(tmp_path, self.path)
+        self._last_save = time.monotonic()
+
+
+class Progress:
+    """Thread safe counters, printed periodically."""
+
+    def __init__(self):
+        self.points = 0
+        self.messages = 0
+        self.started_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, messages, points):
+        with self._lock:
+            self.messages += messages
+            self.points += points
+
+    def report(self):
+        elapsed = time.monotonic() - self.started_at
+        with self._lock:
+            return (f"{self.messages} messages, {self.points} points in {elapsed:.0f}s "
+                    f"({self.points / max(elapsed, 1e-9):.0f} points/s)")
+
+
+def to_records(messages, thingy_id):
+    """Yields (position, records) of each message of data_messages."""
+    for position, message, timestamp in messages:
+        try:
+            yield position, build_records(message["data"], message["appId"], thingy_id, timestamp)
+        except Exception:
+            yield position, [] # Invalid message, skipped
+
+
+def batches(records, batch_size):
+    """Groups records into batches. Yields (position, messages, batch)."""
+    batch = []
+    messages = 0
+    position = None
+    for position, message_records in records:
+        batch.extend(message_records)
+        messages += 1
+        if len(batch) >= batch_size:
+            yield position, messages, batch
+            batch, messages = [], 0
+    if messages:
+        yield position, messages, batch
+
+
+def import_thingy(thingy_id, paths, checkpoint, progress, batch_size):
+    """Imports all day files of one thingy, in order."""
+    write_api = client.write_api(write_options=SYNCHRONOUS)
+    app_ids = set(INFLUX_DATA_IDS)
+    for path in paths:
+        stat = os.stat(path)
+        # The last line of today's file can still be being written: imported next time
+        messages = data_messages(read_day_file(path, app_ids, skip_partial=True), app_ids,
+                                 skip=checkpoint.get(path))
+        for position, messages_count, batch in batches(to_records(messages, thingy_id), batch_size):
+            if batch:
+                write_with_retry(write_api, batch)
+            checkpoint.set(path, position, stat)
+            progress.add(messages_count, len(batch))
+    logging.info(f"Backfill of {thingy_id} done.")
+
+
+def write_with_retry(write_api, batch):
+    delay = 1
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            write_api.write(bucket=bucket, org=org, record=batch)
+            return
+        except Exception as e:
+            if attempt == MAX_RETRIES:
+                raise
+            logging.warning(f"Backfill write failed, retrying in {delay}s: {e}")
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
+
+
+def backfill(data_dir, thingy_ids=None, start=None, end=None, batch_size=10000,
+             workers=4, checkpoint_path="data/.backfill_checkpoint.json"):
+    """Imports day files (optionally between start and end days, included),
+    in parallel across thingys. Returns False if a thingy failed, or if
+    there was no file to import."""
+    files = {}
+    for thingy_id, day, path in day_files(data_dir, thingy_ids):
+        # A day can have both an archive and a text file (late messages)
+        if (start and day < start.strftime('%Y%m%d')) or (end and day > end.strftime('%Y%m%d')):
+            continue
+        files.setdefault(thingy_id, []).append(path)
+    if not files:
+        print(f"No backup files to import in {data_dir}.")
+        return False
+
+    checkpoint = Checkpoint(checkpoint_path)
+    progress = Progress()
+    done = threading.Event()
+
+    def report():
+        while not done.wait(5):
+            print(progress.report(), flush=True)
+    threading.Thread(target=report, daemon=True).start()
+
+    ok = True
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {thingy_id: executor.submit(import_thingy, thingy_id, paths, checkpoint, progress, batch_size)
+                   for thingy_id, paths in files.items()}
+        for thingy_id, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                ok = False
+                print(f"Backfill of {thingy_id} failed, rerun to resume: {e}", flush=True)
+
+    done.set()
+    checkpoint.save()
+    print(f"Done: {progress.report()}")
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import backup day files and archives into Influxdb.")
+    parser.add_argument("--data-dir", default="data")
+    parser.add_argument("--thingy", action="append", help="thingy id (repeatable), default all")
+    parser.add_argument("--start", type=datetime.fromisoformat, help="first day, e.g., 2023-12-01")
+    parser.add_argument("--end", type=datetime.fromisoformat, help="last day (included)")
+    parser.add_argument("--batch-size", type=int, default=10000, help="records per Influxdb write")
+    parser.add_argument("--workers", type=int, default=4, help="thingys imported in parallel")
+    parser.add_argument("--checkpoint", default="data/.backfill_checkpoint.json")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint")
+    args = parser.parse_args(argv)
+
+    if args.restart and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    ok = backfill(args.data_dir, args.thingy, args.start, args.end,
+                  args.batch_size, args.workers, args.checkpoint)
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,192 @@
+"""
+Buffered writer for thingy backup files (data/{thingy_id}/{yyyymmdd}.txt).
+Keeps one open file per thingy and day, buffers lines and writes them
+on size or time, instead of opening the file for every message.
+Created on: 18 october 2026
+"""
+
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+
+class BackupWriter:
+    """Appends raw messages to per-thingy daily backup files.
+
+    Lines are written when a file buffer reaches flush_bytes, or every
+    flush_interval seconds. Files are fsynced at most every fsync_interval
+    seconds (bounding data lost on power failure), closed after idle_timeout
+    seconds without messages, and rotated at midnight.
+
+    Disk writes and fsyncs never run under the writer lock: each file has a
+    buffer lock (held only to append or swap lines) and an io lock (held while
+    writing), so a slow disk only delays the thingy whose file is written.
+    Lines of failed writes are kept for the next flush, up to max_buffer_bytes
+    per file, then dropped (counted in stats)."""
+
+    def __init__(self, directory="data", flush_bytes=64 * 1024, flush_interval=1.0,
+                 idle_timeout=300.0, fsync_interval=30.0, max_buffer_bytes=16 * 1024 * 1024):
+        self.directory = directory
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.idle_timeout = idle_timeout
+        self.fsync_interval = fsync_interval
+        self.max_buffer_bytes = max_buffer_bytes
+
+        self._files = {} # Key= thingy id, Obj= _BackupFile of the current day
+        self._lock = threading.Lock() # Guards _files only
+        self._stats_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = None
+        self._stats = {"lines": 0, "flushes": 0, "fsyncs": 0, "opened": 0, "closed": 0,
+                       "errors": 0, "dropped_lines": 0}
+
+    def append(self, data, thingy_id):
+        """Buffers one message for the backup file of today."""
+        while True:
+            day = datetime.now().strftime('%Y%m%d')
+            rotated = None
+            with self._lock:
+                if self._thread is None:
+                    self._start()
+                backup_file = self._files.get(thingy_id)
+                if backup_file is not None and backup_file.day != day:
+                    # Midnight: rotate to the file of the new day
+                    rotated = self._files.pop(thingy_id)
+                    backup_file = None
+                if backup_file is None:
+                    backup_file = _BackupFile(os.path.join(self.directory, thingy_id, f'{day}.txt'), day)
+                    self._files[thingy_id] = backup_file
+                # Set under the writer lock: the file is not seen as idle
+                backup_file.last_append = time.monotonic()
+            if rotated is not None:
+                self._close_file(rotated)
+
+            with backup_file.lock:
+                if backup_file.closed:
+                    continue # Closed by the background thread meanwhile (midnight)
+                backup_file.buffer.append(data + '\n')
+                backup_file.buffered_bytes += len(data) + 1
+                full = backup_file.buffered_bytes >= self.flush_bytes
+            break
+        self._count("lines")
+        if full:
+            self._flush(backup_file)
+
+    def close(self):
+        """Writes all buffered lines and closes all files."""
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            files, self._files = list(self._files.values()), {}
+        for backup_file in files:
+            self._close_file(backup_file)
+
+    def stats(self):
+        """Returns writer counters, for monitoring."""
+        with self._lock:
+            open_files = sum(1 for f in self._files.values() if f.handle)
+        with self._stats_lock:
+            return {**self._stats, "open_files": open_files}
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name="backup-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._closed.wait(self.flush_interval):
+            now = time.monotonic()
+            day = datetime.now().strftime('%Y%m%d')
+            with self._lock:
+                expired = [thingy_id for thingy_id, backup_file in self._files.items()
+                           if backup_file.day != day or now - backup_file.last_append > self.idle_timeout]
+                closing = [self._files.pop(thingy_id) for thingy_id in expired]
+                files = list(self._files.values())
+            # Files are written outside of the writer lock
+            for backup_file in closing:
+                self._close_file(backup_file)
+            for backup_file in files:
+                self._flush(backup_file)
+                if backup_file.dirty and now - backup_file.last_fsync >= self.fsync_interval:
+                    with backup_file.io_lock:
+                        self._fsync(backup_file)
+
+    def _flush(self, backup_file, final=False):
+        """Writes buffered lines. On failure, lines are put back in the buffer
+        (dropped if the buffer is too large, or if final)."""
+        with backup_file.io_lock:
+            # Lines are swapped under the io lock, so that they are written in order
+            with backup_file.lock:
+                lines, backup_file.buffer = backup_file.buffer, []
+                size, backup_file.buffered_bytes = backup_file.buffered_bytes, 0
+            if not lines:
+                return
+            try:
+                if backup_file.handle is None:
+                    os.makedirs(os.path.dirname(backup_file.path), exist_ok=True)
+                    backup_file.handle = open(backup_file.path, 'a')
+                    backup_file.last_fsync = time.monotonic()
+                    self._count("opened")
+                backup_file.handle.write("".join(lines))
+                backup_file.handle.flush()
+                backup_file.dirty = True
+                self._count("flushes")
+            except Exception as e:
+                self._count("errors")
+                logging.error(f"Error when writing backup file {backup_file.path}: {e}")
+                with backup_file.lock:
+                    if final or size + backup_file.buffered_bytes > self.max_buffer_bytes:
+                        self._count("dropped_lines", len(lines))
+                        logging.error(f"{len(lines)} lines of backup file {backup_file.path} dropped.")
+                    else:
+                        # Retried at next flush, before lines appended since
+                        backup_file.buffer[:0] = lines
+                        backup_file.buffered_bytes += size
+
+    def _fsync(self, backup_file):
+        """Must be called with the file io lock held."""
+        try:
+            os.fsync(backup_file.handle.fileno())
+            self._count("fsyncs")
+        except Exception as e:
+            self._count("errors")
+            logging.error(f"Error when syncing backup file {backup_file.path}: {e}")
+        backup_file.dirty = False
+        backup_file.last_fsync = time.monotonic()
+
+    def _close_file(self, backup_file):
+        """Flushes, syncs and closes a file removed from _files."""
+        with backup_file.lock:
+            backup_file.closed = True # Later appends go to a new file
+        self._flush(backup_file, final=True)
+        with backup_file.io_lock:
+            if backup_file.handle is not None:
+                if backup_file.dirty:
+                    self._fsync(backup_file)
+                backup_file.handle.close()
+                backup_file.handle = None
+                self._count("closed")
+
+    def _count(self, name, value=1):
+        with self._stats_lock:
+            self._stats[name] += value
+
+
+class _BackupFile:
+    """Backup file of one thingy for one day, with its buffered lines."""
+
+    def __init__(self, path, day):
+        self.path = path
+        self.day = day
+        self.handle = None # Opened on first flush
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.lock = threading.Lock() # Guards buffer and buffered_bytes
+        self.io_lock = threading.Lock() # Held while writing, syncing or closing
+        self.last_append = time.monotonic()
+        self.last_fsync = time.monotonic()
+        self.dirty = False # Written since last fsync
+        self.closed = False
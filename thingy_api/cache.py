@@ -0,0 +1,129 @@
+"""
+In-memory caches for serialized API responses.
+Created on: 18 october 2026
+"""
+
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """Asyncio cache of response bodies (bytes) with a TTL per entry.
+
+    Concurrent misses on the same key share one load (single-flight), which is
+    cancelled if all requests waiting for it are cancelled (clients disconnected).
+    When the cache exceeds max_bytes, least recently used entries are evicted."""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict() # Key= cache key, Obj= (expires_at, body)
+        self._loading = {} # Key= cache key, Obj= asyncio task loading the body
+        self._waiters = {} # Key= cache key, Obj= number of requests awaiting the load
+        self._bytes = 0
+        self._stats = {"hits": 0, "misses": 0, "shared_loads": 0, "evictions": 0, "cancelled_loads": 0}
+
+    async def get_or_load(self, key, loader, ttl):
+        """Returns the cached body of key, or awaits loader() to get it.
+        :param loader: coroutine function returning bytes, or None (not cached).
+        :param ttl: seconds during which the loaded body stays valid."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, body = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                return body
+            self._remove(key)
+
+        task = self._loading.get(key)
+        if task is not None:
+            self._stats["shared_loads"] += 1
+        else:
+            self._stats["misses"] += 1
+            task = asyncio.ensure_future(self._load(key, loader, ttl))
+            self._loading[key] = task
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            # Shielded: a cancelled request must not cancel the load shared with others
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self._waiters[key] == 1 and not task.done():
+                # Last request waiting for this load: nobody needs the result
+                task.cancel()
+                del self._loading[key]
+                self._stats["cancelled_loads"] += 1
+            raise
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+
+    def stats(self):
+        """Returns cache counters, for monitoring."""
+        return {**self._stats, "entries": len(self._entries), "bytes": self._bytes,
+                "max_bytes": self.max_bytes, "loading": len(self._loading)}
+
+    async def _load(self, key, loader, ttl):
+        try:
+            body = await loader()
+        finally:
+            # Already removed if cancelled, and maybe replaced by a new load
+            if self._loading.get(key) is asyncio.current_task():
+                del self._loading[key]
+        if body is not None and ttl > 0 and len(body) <= self.max_bytes:
+            self._entries[key] = (time.monotonic() + ttl, body)
+            self._bytes += len(body)
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+        return body
+
+    def _remove(self, key):
+        _, body = self._entries.pop(key)
+        self._bytes -= len(body)
+
+
+class SnapshotCache:
+    """Asyncio cache of one serialized JSON resource (e.g., all plants) with its ETag.
+
+    The body is reloaded when invalidate() was called, when the version given
+    to get() changes, or after ttl seconds (changes made outside of the API).
+    The ETag is a hash of the body, so it stays the same across reloads and
+    restarts as long as the content does not change."""
+
+    def __init__(self, ttl=60.0):
+        self.ttl = ttl
+        self._generation = 0
+        self._entry = None # (version, expires_at, etag, body)
+        self._lock = asyncio.Lock()
+        self._stats = {"hits": 0, "loads": 0, "invalidations": 0}
+
+    def invalidate(self):
+        """Forces a reload on next get (call after each write of the resource)."""
+        self._generation += 1
+        self._stats["invalidations"] += 1
+
+    async def get(self, loader, version=None):
+        """Returns (etag, body), loading the body with loader() if needed.
+        :param loader: coroutine function returning the resource (JSON serializable).
+        Errors must be raised by loader: exceptions are propagated and nothing is cached."""
+        async with self._lock:
+            # Captured before loading: a write during the load triggers another reload
+            version = (self._generation, version)
+            entry = self._entry
+            if entry is not None and entry[0] == version and entry[1] > time.monotonic():
+                self._stats["hits"] += 1
+                return entry[2], entry[3]
+
+            body = json.dumps(await loader()).encode()
+            etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+            self._entry = (version, time.monotonic() + self.ttl, etag, body)
+            self._stats["loads"] += 1
+            return etag, body
+
+    def stats(self):
+        """Returns cache counters, for monitoring."""
+        return {**self._stats, "ttl": self.ttl}
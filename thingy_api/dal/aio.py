@@ -0,0 +1,63 @@
+"""
+Asyncio variant of the access layer, to be used from aiohttp handlers.
+Each function has the same name, parameters and return value as its
+synchronous counterpart, but runs on a dedicated thread pool sized like
+the database connection pool, so queries never block the event loop.
+Created on: 18 october 2026
+"""
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import thingy_api.dal.maintenance as maintenance_dal
+import thingy_api.dal.plant as plant_dal
+import thingy_api.dal.thingy_id as thingy_id_dal
+import thingy_api.dal.user as user_dal
+from thingy_api.dal.pool import POOL_MAX_SIZE
+
+# Sized like the connection pool, so that handlers don't queue more queries than
+# there are connections. The pool is shared with MQTT workers, the last seen flush
+# and the registry: threads can still wait for a connection (up to DB_POOL_TIMEOUT).
+executor = ThreadPoolExecutor(max_workers=POOL_MAX_SIZE, thread_name_prefix="dal")
+
+
+async def run(function, *args, **kwargs):
+    """Runs a synchronous access layer function on the dal executor."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(function, *args, **kwargs))
+
+
+def async_variant(function):
+    """Returns a coroutine function wrapping a synchronous dal function."""
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        return await run(function, *args, **kwargs)
+    return wrapper
+
+
+# Plants
+get_all_plants = async_variant(plant_dal.get_all_plants)
+get_plant = async_variant(plant_dal.get_plant)
+create_plant = async_variant(plant_dal.create_plant)
+update_plant = async_variant(plant_dal.update_plant)
+delete_plant = async_variant(plant_dal.delete_plant)
+
+# Users
+get_all_users = async_variant(user_dal.get_all_users)
+get_user = async_variant(user_dal.get_user)
+get_user_dev = async_variant(user_dal.get_user_dev)
+
+# Thingy ids
+get_all_thingy_ids = async_variant(thingy_id_dal.get_all_thingy_ids)
+add_new_id = async_variant(thingy_id_dal.add_new_id)
+update_id = async_variant(thingy_id_dal.update_id)
+
+# Maintenance
+get_maintenance_status = async_variant(maintenance_dal.get_maintenance_status)
+reset_maintenance_status = async_variant(maintenance_dal.reset_maintenance_status)
+set_maintenance_start = async_variant(maintenance_dal.set_maintenance_start)
+set_maintenance_end = async_variant(maintenance_dal.set_maintenance_end)
+get_maintenance_history = async_variant(maintenance_dal.get_maintenance_history)
+get_all_maintenance_thingies = async_variant(maintenance_dal.get_all_maintenance_thingies)
+add_new_thingy_id = async_variant(maintenance_dal.add_new_thingy_id)
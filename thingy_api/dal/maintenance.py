@@ -6,25 +6,18 @@ Updated by: -
 
 # take environment variables from api.env
 import logging
-from os import getenv
 from dotenv import load_dotenv
-import psycopg2
 
 from thingy_api.dal.plant import transform_data
+from thingy_api.dal.pool import db_connection
 
 
 load_dotenv(dotenv_path='environments/api.env')
 
 def get_maintenance_status(thingy_id):
     """Get one plant by id from database."""
-    # Establish a connection to your PostgreSQL database
-    with psycopg2.connect(
-        dbname="thingy_db",
-        user=getenv('DB_USER'),
-        password=getenv('DB_PASSWORD'),
-        host=getenv('DB_URL'),
-        port=getenv('DB_PORT')
-    ) as conn:
+    # Get a connection from the shared pool
+    with db_connection() as conn:
         cursor = conn.cursor()
 
         query = f'SELECT maintenance_status FROM public."Maintenance" WHERE thingy_id=\'{thingy_id}\''
@@ -47,14 +40,8 @@ def get_maintenance_status(thingy_id):
 
 def reset_maintenance_status():
     """Update the inMaintenance field for all plants."""
-     # Establish a connection to your PostgreSQL database
-    with psycopg2.connect(
-        dbname="thingy_db",
-        user=getenv('DB_USER'),
-        password=getenv('DB_PASSWORD'),
-        host=getenv('DB_URL'),
-        port=getenv('DB_PORT')
-    ) as conn:
+     # Get a connection from the shared pool
+    with db_connection() as conn:
         cursor = conn.cursor()
 
         query = f"""
@@ -80,14 +67,8 @@ def reset_maintenance_status():
 
 def set_maintenance_end(thingy_id):
     """Set maintenance end"""
-     # Establish a connection to your PostgreSQL database
-    with psycopg2.connect(
-        dbname="thingy_db",
-        user=getenv('DB_USER'),
-        password=getenv('DB_PASSWORD'),
-        host=getenv('DB_URL'),
-        port=getenv('DB_PORT')
-    ) as conn:
+     # Get a connection from the shared pool
+    with db_connection() as conn:
         cursor = conn.cursor()
 
         query = f"""
@@ -112,14 +93,8 @@ def set_maintenance_end(thingy_id):
         
 def set_maintenance_start(thingy_id):
     """Set maintenance end"""
-     # Establish a connection to your PostgreSQL database
-    with psycopg2.connect(
-        dbname="thingy_db",
-        user=getenv('DB_USER'),
-        password=getenv('DB_PASSWORD'),
-        host=getenv('DB_URL'),
-        port=getenv('DB_PORT')
-    ) as conn:
+     # Get a connection from the shared pool
+    with db_connection() as conn:
         cursor = conn.cursor()
 
         query = f"""
@@ -144,14 +119,8 @@ def set_maintenance_start(thingy_id):
 
 def get_maintenance_history(thingy_id):
     """Get maintenacne data for plant by thingy_id from database."""
-    # Establish a connection to your PostgreSQL database
-    with psycopg2.connect(
-        dbname="thingy_db",
-        user=getenv('DB_USER'),
-        password=getenv('DB_PASSWORD'),
-        host=getenv('DB_URL'),
-        port=getenv('DB_PORT')
-    ) as conn:
+    # Get a connection from the shared pool
+    with db_connection() as conn:
         cursor = conn.cursor()
 
         query = f'SELECT * FROM public."Maintenance" WHERE thingy_id=\'{thingy_id}\''
@@ -178,14 +147,8 @@ def get_maintenance_history(thingy_id):
 
 def get_all_maintenance_thingies():
     """Get all thingy ids"""
-    # Establish a connection to your PostgreSQL database
-    with psycopg2.connect(
-        dbname="thingy_db",
-        user=getenv('DB_USER'),
-        password=getenv('DB_PASSWORD'),
-        host=getenv('DB_URL'),
-        port=getenv('DB_PORT')
-    ) as conn:
+    # Get a connection from the shared pool
+    with db_connection() as conn:
         cursor = conn.cursor()
 
         query = 'SELECT thingy_id FROM public."Maintenance"'
@@ -219,14 +182,8 @@ def get_all_maintenance_thingies():
 
 def add_new_thingy_id(thingy_id):
     """Create new thingy_ids."""
-    # Establish a connection to your PostgreSQL database
-    with psycopg2.connect(
-        dbname="thingy_db",
-        user=getenv('DB_USER'),
-        password=getenv('DB_PASSWORD'),
-        host=getenv('DB_URL'),
-        port=getenv('DB_PORT')
-    ) as conn:
+    # Get a connection from the shared pool
+    with db_connection() as conn:
         cursor = conn.cursor()
 
         query = f"""
@@ -6,32 +6,31 @@ Updated by: LK on 20.12.2023
 from datetime import datetime
 from decimal import Decimal
 import logging
-from os import getenv
 import uuid
 
-import psycopg2
 from dotenv import load_dotenv
 from psycopg2 import sql
 
-from thingy_api.dal.user import get_user
+from thingy_api.dal.pool import db_connection
 
 # take environment variables from api.env
 load_dotenv(dotenv_path='environments/api.env')
 
+# Plants joined with their contact person, as a json object (one query for all plants).
+PLANT_WITH_CONTACT_QUERY = """
+    SELECT p.*, row_to_json(u) AS contact_person_info
+    FROM public."Plant" p
+    LEFT JOIN keycloak.user_entity u ON u.id = p.contact_person
+"""
+
 
 def get_all_plants():
     """Get all plants from database."""
-    # Establish a connection to your PostgreSQL database
-    with psycopg2.connect(
-        dbname="thingy_db",
-        user=getenv('DB_USER'),
-        password=getenv('DB_PASSWORD'),
-        host=getenv('DB_URL'),
-        port=getenv('DB_PORT')
-    ) as conn:
+    # Get a connection from the shared pool
+    with db_connection() as conn:
         cursor = conn.cursor()
 
-        query = 'SELECT * FROM public."Plant"'
+        query = PLANT_WITH_CONTACT_QUERY
 
         try:
             # Execute the SELECT query
@@ -47,7 +46,7 @@ def get_all_plants():
             dict_data = []
             for row in modified_data:
                 row_dict = {col_name: value for col_name, value in zip(column_names, row)}
-                row_dict["contact_person"] = get_user(row_dict["contact_person"]) # Adds user info
+                add_contact_person(row_dict) # Adds user info
                 dict_data.append(row_dict)
 
             return dict_data
@@ -59,17 +58,11 @@ def get_all_plants():
 
 def get_plant(plant_id):
     """Get one plant by id from database."""
-    # Establish a connection to your PostgreSQL database
-    with psycopg2.connect(
-        dbname="thingy_db",
-        user=getenv('DB_USER'),
-        password=getenv('DB_PASSWORD'),
-        host=getenv('DB_URL'),
-        port=getenv('DB_PORT')
-    ) as conn:
+    # Get a connection from the shared pool
+    with db_connection() as conn:
         cursor = conn.cursor()
 
-        query = f'SELECT * FROM public."Plant" WHERE id=\'{plant_id}\''
+        query = PLANT_WITH_CONTACT_QUERY + f' WHERE p.id=\'{plant_id}\''
 
         try:
             # Execute the SELECT query
@@ -85,7 +78,7 @@ def get_plant(plant_id):
             # Match data values to column names and put into a python dict
             dict_data = []
             result = {col_name: value for col_name, value in zip(column_names, modified_data)}
-            result["contact_person"] = get_user(result["contact_person"]) # Adds user info
+            add_contact_person(result) # Adds user info
             return result
         except Exception as e:
             conn.rollback()
@@ -99,14 +92,8 @@ def create_plant(values):
     #Generate ID
     values["id"]= str(uuid.uuid4())
 
-    # Establish a connection to your PostgreSQL database
-    with psycopg2.connect(
-        dbname="thingy_db",
-        user=getenv('DB_USER'),
-        password=getenv('DB_PASSWORD'),
-        host=getenv('DB_URL'),
-        port=getenv('DB_PORT')
-    ) as conn:
+    # Get a connection from the shared pool
+    with db_connection() as conn:
         cursor = conn.cursor()
 
         query = sql.SQL("""
@@ -139,14 +126,8 @@ def create_plant(values):
 
 def update_plant(plant_id, values):
     """Update a plant by id."""
-    # Establish a connection to your PostgreSQL database
-    with psycopg2.connect(
-        dbname="thingy_db",
-        user=getenv('DB_USER'),
-        password=getenv('DB_PASSWORD'),
-        host=getenv('DB_URL'),
-        port=getenv('DB_PORT')
-    ) as conn:
+    # Get a connection from the shared pool
+    with db_connection() as conn:
         cursor = conn.cursor()
 
         query = f"""
@@ -180,14 +161,8 @@ def update_plant(plant_id, values):
 
 def delete_plant(plant_id):
     """Delete a plant by id."""
-    # Establish a connection to your PostgreSQL database
-    with psycopg2.connect(
-        dbname="thingy_db",
-        user=getenv('DB_USER'),
-        password=getenv('DB_PASSWORD'),
-        host=getenv('DB_URL'),
-        port=getenv('DB_PORT')
-    ) as conn:
+    # Get a connection from the shared pool
+    with db_connection() as conn:
         cursor = conn.cursor()
 
         query = f'DELETE FROM public."Plant" WHERE id=\'{plant_id}\''
@@ -204,6 +179,15 @@ def delete_plant(plant_id):
             return {"message": "error when deleting a plant."}
 
 
+def add_contact_person(plant):
+    """Replaces the contact_person id of a plant row by the joined user
+    row (contact_person_info column). Same shape as dal.user.get_user()."""
+    contact_person = plant.pop("contact_person_info", None)
+    if contact_person is None:
+        contact_person = {"message": "error when retrieving user."}
+    plant["contact_person"] = contact_person
+
+
 def transform_data(data):
     """Converts all decimals and datetime objects to json serializable types.
     Includes Decimal to float and datetime to timestamp."""
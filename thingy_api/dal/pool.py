@@ -0,0 +1,238 @@
+"""
+Shared PostgreSQL connection pool used by all access layer functions.
+Use db_connection() instead of opening a new connection with psycopg2.connect().
+Created on: 18 october 2026
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from os import getenv
+
+import psycopg2
+from dotenv import load_dotenv
+from psycopg2 import extensions
+from psycopg2.pool import PoolError
+
+# take environment variables from api.env
+load_dotenv(dotenv_path='environments/api.env')
+
+POOL_MIN_SIZE = int(getenv('DB_POOL_MIN_SIZE', "1"))
+POOL_MAX_SIZE = int(getenv('DB_POOL_MAX_SIZE', "10"))
+# Idle connections above POOL_MIN_SIZE are closed after this delay (seconds).
+POOL_IDLE_TIMEOUT = float(getenv('DB_POOL_IDLE_TIMEOUT', "300"))
+# Connections idle for longer than this are checked with "SELECT 1" before reuse.
+POOL_HEALTH_CHECK_AFTER = float(getenv('DB_POOL_HEALTH_CHECK_AFTER', "30"))
+# Max time to wait for a free connection when the pool is exhausted.
+POOL_TIMEOUT = float(getenv('DB_POOL_TIMEOUT', "10"))
+
+
+class ConnectionPool:
+    """Thread safe pool of psycopg2 connections with idle timeout and
+    health checks. Connections are created lazily up to max_size."""
+
+    def __init__(self, min_size, max_size, idle_timeout, health_check_after, timeout, **connect_kwargs):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_after = health_check_after
+        self.timeout = timeout
+        self.connect_kwargs = connect_kwargs
+
+        self._idle = deque() # (connection, last time used), most recent on the right
+        self._size = 0 # Connections opened (idle + in use + being opened)
+        self._waiting = 0
+        self._cond = threading.Condition()
+        self._stats = {"created": 0, "closed": 0, "checkouts": 0,
+                       "timeouts": 0, "failed_health_checks": 0}
+
+    def open(self):
+        """Opens min_size connections in advance."""
+        connections = []
+        for _ in range(self.min_size):
+            connections.append(self.getconn())
+        for conn in connections:
+            self.putconn(conn)
+
+    def getconn(self):
+        """Returns a healthy connection, waiting up to timeout seconds
+        if all connections are in use. Raises PoolError on timeout."""
+        deadline = time.monotonic() + self.timeout
+        self.reap()
+        while True:
+            with self._cond:
+                conn, last_used = self._wait_for_connection(deadline)
+                self._stats["checkouts"] += 1
+
+            if conn is None:
+                # A slot was reserved for a new connection
+                try:
+                    conn = psycopg2.connect(**self.connect_kwargs)
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self._stats["created"] += 1
+                return conn
+
+            if time.monotonic() - last_used < self.health_check_after or self._is_healthy(conn):
+                return conn
+
+            with self._cond:
+                self._stats["failed_health_checks"] += 1
+            self._close(conn)
+
+    def putconn(self, conn, discard=False):
+        """Gives a connection back to the pool. Broken connections,
+        or connections left inside a transaction, are closed."""
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                discard = True
+        if discard or conn.closed:
+            self._close(conn)
+            return
+
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            expired = self._pop_expired()
+            self._cond.notify()
+        for old_conn in expired:
+            self._close(old_conn)
+
+    def reap(self):
+        """Closes connections idle for longer than idle_timeout (above min_size).
+        Also done by getconn and putconn: call it periodically when traffic stops."""
+        with self._cond:
+            expired = self._pop_expired()
+        for conn in expired:
+            self._close(conn)
+
+    def closeall(self):
+        """Closes all idle connections (e.g., on shutdown)."""
+        with self._cond:
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+        for conn in idle:
+            self._close(conn)
+
+    def stats(self):
+        """Returns pool usage counters, for monitoring."""
+        with self._cond:
+            return {
+                **self._stats,
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "waiting": self._waiting,
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+            }
+
+    def _wait_for_connection(self, deadline):
+        """Must be called with the lock held. Returns an idle (connection, last_used),
+        or (None, None) after reserving a slot for a new connection."""
+        while True:
+            if self._idle:
+                return self._idle.pop()
+            if self._size < self.max_size:
+                self._size += 1
+                return None, None
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._stats["timeouts"] += 1
+                raise PoolError(f"no database connection available after {self.timeout}s")
+            self._waiting += 1
+            try:
+                self._cond.wait(remaining)
+            finally:
+                self._waiting -= 1
+
+    def _pop_expired(self):
+        """Must be called with the lock held. Removes connections idle for
+        longer than idle_timeout, keeping at least min_size connections."""
+        expired = []
+        now = time.monotonic()
+        while (self._idle and self._size - len(expired) > self.min_size
+               and now - self._idle[0][1] > self.idle_timeout):
+            expired.append(self._idle.popleft()[0])
+        return expired
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception as e:
+            logging.warning(f"Discarding broken database connection: {e}")
+            return False
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._stats["closed"] += 1
+            self._cond.notify()
+
+
+pool = ConnectionPool(
+    min_size=POOL_MIN_SIZE,
+    max_size=POOL_MAX_SIZE,
+    idle_timeout=POOL_IDLE_TIMEOUT,
+    health_check_after=POOL_HEALTH_CHECK_AFTER,
+    timeout=POOL_TIMEOUT,
+    dbname="thingy_db",
+    user=getenv('DB_USER'),
+    password=getenv('DB_PASSWORD'),
+    host=getenv('DB_URL'),
+    port=getenv('DB_PORT')
+)
+
+# Connection currently used by this thread, so that nested access layer
+# calls (e.g. create_plant() returning get_plant()) reuse it.
+_local = threading.local()
+
+
+@contextmanager
+def db_connection():
+    """Context manager giving a pooled connection. Like psycopg2 connections,
+    the transaction is committed on success and rolled back on error.
+    Nested calls on the same thread share the same connection."""
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        yield conn
+        return
+
+    conn = pool.getconn()
+    _local.conn = conn
+    discard = False
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            discard = True
+        raise
+    finally:
+        _local.conn = None
+        pool.putconn(conn, discard=discard)
+
+
+def get_pool_stats():
+    """Returns connection pool statistics, for monitoring."""
+    return pool.stats()
@@ -4,21 +4,16 @@ Created by: Jean-Marie Alder on 10 november 2023
 """
 
 import logging
-from os import getenv
 
-import psycopg2
+from psycopg2.extras import execute_values
+
+from thingy_api.dal.pool import db_connection
 
 
 def get_all_thingy_ids():
     """Get all thingy_ids."""
-    # Establish a connection to your PostgreSQL database
-    with psycopg2.connect(
-        dbname="thingy_db",
-        user=getenv('DB_USER'),
-        password=getenv('DB_PASSWORD'),
-        host=getenv('DB_URL'),
-        port=getenv('DB_PORT')
-    ) as conn:
+    # Get a connection from the shared pool
+    with db_connection() as conn:
         cursor = conn.cursor()
 
         query = f"SELECT * FROM public.thingy_id"
@@ -50,14 +45,8 @@ def get_all_thingy_ids():
 
 def add_new_id(thingy_id):
     """Create new thingy_ids."""
-    # Establish a connection to your PostgreSQL database
-    with psycopg2.connect(
-        dbname="thingy_db",
-        user=getenv('DB_USER'),
-        password=getenv('DB_PASSWORD'),
-        host=getenv('DB_URL'),
-        port=getenv('DB_PORT')
-    ) as conn:
+    # Get a connection from the shared pool
+    with db_connection() as conn:
         cursor = conn.cursor()
 
         query = f"""
@@ -70,7 +59,7 @@ def add_new_id(thingy_id):
             cursor.execute(query)
             conn.commit()
             logging.info(f"thingy_id added successfully. {thingy_id}")
-            return get_all_thingy_ids()
+            return
         except Exception as e:
             conn.rollback()
             logging.error(f"Error: {e}")
@@ -80,14 +69,8 @@ def add_new_id(thingy_id):
 def update_id(thingy_id):
     """update thingy_id timestamp. Keeps track of wether the thingy
        is active or not."""
-    # Establish a connection to your PostgreSQL database
-    with psycopg2.connect(
-        dbname="thingy_db",
-        user=getenv('DB_USER'),
-        password=getenv('DB_PASSWORD'),
-        host=getenv('DB_URL'),
-        port=getenv('DB_PORT')
-    ) as conn:
+    # Get a connection from the shared pool
+    with db_connection() as conn:
         cursor = conn.cursor()
 
         query = f"""
@@ -101,8 +84,36 @@ def update_id(thingy_id):
             # Execute the INSERT query
             cursor.execute(query)
             conn.commit()
-            return get_all_thingy_ids()
+            return
+        except Exception as e:
+            conn.rollback()
+            logging.error(f"Error: {e}")
+            return {"message": "error when updating a thingy id."}
+
+
+def update_ids_last_seen(last_seen):
+    """Bulk update of thingy_id timestamps, in one query.
+    :param last_seen: dict, key= thingy id, value= datetime of last message."""
+    if not last_seen:
+        return
+    # Get a connection from the shared pool
+    with db_connection() as conn:
+        cursor = conn.cursor()
+
+        query = """
+            UPDATE public.thingy_id AS t
+            SET updated_at = v.last_seen
+            FROM (VALUES %s) AS v (name, last_seen)
+            WHERE
+                t.name = v.name
+        """
+
+        try:
+            # Execute the UPDATE query with all (name, last_seen) rows
+            execute_values(cursor, query, list(last_seen.items()), template="(%s, %s::timestamptz)")
+            conn.commit()
+            return
         except Exception as e:
             conn.rollback()
             logging.error(f"Error: {e}")
-            return {"message": "error when updating a thingy id."}
\ No newline at end of file
+            return {"message": "error when updating thingy ids last seen."}
@@ -3,21 +3,14 @@ Access layer function for users.
 Created by: Jean-Marie Alder on 10 november 2023
 """
 import logging
-from os import getenv
 
-import psycopg2
+from thingy_api.dal.pool import db_connection
 
 
 def get_all_users():
     """Get all users from database."""
-    # Establish a connection to your PostgreSQL database
-    with psycopg2.connect(
-        dbname="thingy_db",
-        user=getenv('DB_USER'),
-        password=getenv('DB_PASSWORD'),
-        host=getenv('DB_URL'),
-        port=getenv('DB_PORT')
-    ) as conn:
+    # Get a connection from the shared pool
+    with db_connection() as conn:
         cursor = conn.cursor()
 
         query = 'SELECT * FROM keycloak.user_entity'
@@ -44,14 +37,8 @@ def get_all_users():
 
 def get_user(user_id):
     """Get one user by id."""
-    # Establish a connection to your PostgreSQL database
-    with psycopg2.connect(
-        dbname="thingy_db",
-        user=getenv('DB_USER'),
-        password=getenv('DB_PASSWORD'),
-        host=getenv('DB_URL'),
-        port=getenv('DB_PORT')
-    ) as conn:
+    # Get a connection from the shared pool
+    with db_connection() as conn:
         cursor = conn.cursor()
 
         query = f"SELECT * FROM keycloak.user_entity WHERE id='{user_id}'"
@@ -74,14 +61,8 @@ def get_user(user_id):
 
 def get_user_dev():
     """Get the first user of the database (dev)."""
-    # Establish a connection to your PostgreSQL database
-    with psycopg2.connect(
-        dbname="thingy_db",
-        user=getenv('DB_USER'),
-        password=getenv('DB_PASSWORD'),
-        host=getenv('DB_URL'),
-        port=getenv('DB_PORT')
-    ) as conn:
+    # Get a connection from the shared pool
+    with db_connection() as conn:
         cursor = conn.cursor()
 
         query = 'SELECT * FROM keycloak.user_entity LIMIT 1'
@@ -4,15 +4,22 @@ Created by: Jean-Marie Alder on 9 november 2023
 Updated by: Jean-Marie Alder on 6 dec 2023
 """
 
-from datetime import datetime
+import asyncio
+from datetime import datetime, timezone
+import json
 import logging
-import random
+import math
+import time
 from os import getenv
 
 import influxdb_client
 from dotenv import load_dotenv
-from influxdb_client import Point
-from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client import Point, WritePrecision
+from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync
+
+from thingy_api.influx_rollup import RollupManager, to_rfc3339
+from thingy_api.influx_spool import Spool
+from thingy_api.influx_writer import BatchWriter
 
 # take environment variables from api.env
 load_dotenv(dotenv_path='environments/api.env')
@@ -22,6 +29,55 @@ org = getenv("INFLUXDB_ORG", "default")
 url = getenv("INFLUXDB_URL", "localhost")
 bucket = getenv("INFLUXDB_BUCKET", "default")
 
+# Records that cannot be written are spooled on disk (disabled if empty).
+spool_dir = getenv("INFLUX_SPOOL_DIR", "data/.influx_spool")
+spool = None
+if spool_dir:
+    spool = Spool(
+        spool_dir,
+        segment_seconds=int(getenv("INFLUX_SPOOL_SEGMENT_SECONDS", "300")),
+        max_bytes=int(getenv("INFLUX_SPOOL_MAX_BYTES", str(512 * 1024 * 1024))),
+    )
+
+# Long-lived client and batching writer shared by all writes.
+client = influxdb_client.InfluxDBClient(url=url, token=token, org=org)
+writer = BatchWriter(
+    client, bucket, org,
+    batch_size=int(getenv("INFLUX_BATCH_SIZE", "1000")),
+    flush_interval=float(getenv("INFLUX_FLUSH_INTERVAL", "1")),
+    buffer_size=int(getenv("INFLUX_BUFFER_SIZE", "100000")),
+    max_retries=int(getenv("INFLUX_MAX_RETRIES", "5")),
+    retry_interval=float(getenv("INFLUX_RETRY_INTERVAL", "1")),
+    max_retry_delay=float(getenv("INFLUX_MAX_RETRY_DELAY", "30")),
+    spool=spool,
+    health_check_interval=float(getenv("INFLUX_HEALTH_CHECK_INTERVAL", "10")),
+)
+
+# Downsampled buckets read by long history queries (disabled if "0")
+rollups = None
+if getenv("INFLUX_ROLLUPS", "1") != "0":
+    rollups = RollupManager(client, bucket, org,
+                            backfill_seconds=int(getenv("INFLUX_ROLLUP_BACKFILL_DAYS", "30")) * 86400)
+
+# Queries run on a shared async client (see get_query_client), with a timeout in seconds.
+QUERY_TIMEOUT = float(getenv("INFLUX_QUERY_TIMEOUT", "30"))
+QUERY_CONNECTIONS = int(getenv("INFLUX_QUERY_CONNECTIONS", "10"))
+query_client = None
+# Streamed histories are written in chunks of about this size (bytes)
+STREAM_CHUNK_BYTES = 64 * 1024
+query_stats = {"queries": 0, "timeouts": 0, "cancelled": 0, "errors": 0}
+
+# Histories between arbitrary start and stop times: default and max values per
+# series, max span, and max span without rollup bucket (raw points are read)
+HISTORY_POINTS = int(getenv("HISTORY_POINTS", "500"))
+HISTORY_MAX_POINTS = int(getenv("HISTORY_MAX_POINTS", "2000"))
+HISTORY_MAX_SPAN = int(getenv("HISTORY_MAX_SPAN_DAYS", "366")) * 86400
+HISTORY_MAX_RAW_SPAN = int(getenv("HISTORY_MAX_RAW_SPAN_DAYS", "30")) * 86400
+# Aggregation windows of these histories (seconds), so that they match rollups and cache well
+HISTORY_WINDOWS = [10, 30, 60, 120, 300, 600, 900, 1800, 3600, 7200, 10800, 21600, 43200, 86400]
+# Max thingys of a batch history request (/api/influx/batch), read with a single query
+HISTORY_BATCH_MAX_IDS = int(getenv("HISTORY_BATCH_MAX_IDS", "50"))
+
 # CONSTANTS
 RANGE_MAP = {
     "30d": "2h",
@@ -54,74 +110,105 @@ COLOR_MAP = {
 }
 
 
-def write_point(value, measurement, thingy_id):
-    """Writes a point with specific label, thingy id and value.
+def write_point(value, measurement, thingy_id, timestamp=None, block=False):
+    """Queues a point with specific label, thingy id and value.
+    The point is written to Influxdb later by the batching writer.
 
     Inputs:
     value: actual numeric data
     measurement: label of data
     thingy_id: e.g., orange-2
+    timestamp: time of the point in nanoseconds (default: now)
+    block: wait for space in the writer buffer (bulk replays)
     """
+    if timestamp is None:
+        timestamp = time.time_ns()
+    try:
+        writer.enqueue(build_records(value, measurement, thingy_id, timestamp), block=block)
+    except Exception as e:
+        logging.error(e)
+    return value
+
+
+def build_records(value, measurement, thingy_id, timestamp):
+    """Returns the line protocol records of a measurement.
+    :param timestamp: time of the measurement, in nanoseconds."""
     if measurement == 'LIGHT':
         # light measurement must be treated separately
-        write_light_points(value, thingy_id)
-    else:
-        try:
-            # Write to Influxdb using InfluxDBClient
-            write_client = influxdb_client.InfluxDBClient(url=url, token=token, org=org)
-            write_api = write_client.write_api(write_options=SYNCHRONOUS)
-            point = (
-                Point(measurement)
-                .tag("location", thingy_id)
-                .field("value", float(value))
-            )
-            write_api.write(bucket=bucket, org="thingy-orange", record=point)
-            return value
-        except Exception as e:
-            logging.error(e)
-            return value
-    
+        return build_light_records(value, thingy_id, timestamp)
+    point = (
+        Point(measurement)
+        .tag("location", thingy_id)
+        .field("value", float(value))
+        .time(timestamp, WritePrecision.NS)
+    )
+    return [point.to_line_protocol()]
+
 
-def write_light_points(value, thingy_id):
-    """Specific method to deal with light data."""
+def build_light_records(value, thingy_id, timestamp):
+    """Specific method to deal with light data (4 values in one message)."""
     labels = ['RED', 'GREEN', 'BLUE', 'INFRARED']
     values = value.split(' ')
 
-    try:
-        # Write to influx all 4 values, only creating influxdb client once.
-        write_client = influxdb_client.InfluxDBClient(url=url, token=token, org=org)
-        write_api = write_client.write_api(write_options=SYNCHRONOUS)
-        for i in range(len(values)):
-            point = (
-                Point(labels[i])
-                .tag("location", thingy_id)
-                .field("value", float(values[i]))
-            )
-            write_api.write(bucket=bucket, org="thingy-orange", record=point)
-    except Exception as e:
-        logging.error(e)
-        return value
+    records = []
+    for i in range(len(values)):
+        point = (
+            Point(labels[i])
+            .tag("location", thingy_id)
+            .field("value", float(values[i]))
+            .time(timestamp, WritePrecision.NS)
+        )
+        records.append(point.to_line_protocol())
+    return records
 
 
-def get_plant_simple_history(thingy_id, range):
-    """Returns the air pressure, temperature and humidity of the 
-    previous 24 hours for a specific plant.
-    :param thingy_id: id of the plant's thingy."""
+def get_query_client():
+    """Returns the async client shared by all queries. It is created on first
+    use, because its HTTP session must belong to the running event loop."""
+    global query_client
+    if query_client is None:
+        query_client = InfluxDBClientAsync(url=url, token=token, org=org,
+                                           timeout=int(QUERY_TIMEOUT * 1000),
+                                           connection_pool_maxsize=QUERY_CONNECTIONS)
+    return query_client
 
-    # Start by chosing relevant aggregation window according to range
-    window = None
+
+async def close_query_client():
+    global query_client
+    if query_client is not None:
+        await query_client.close()
+        query_client = None
+
+
+async def query(flux, stream=False):
+    """Runs a Flux query without blocking the event loop. Returns the tables,
+    or an async generator of records if stream is True (the timeout then only
+    applies until the response starts).
+    Raises asyncio.TimeoutError after QUERY_TIMEOUT seconds; cancelling the
+    calling task (e.g., HTTP client disconnected) aborts the Influxdb request."""
+    query_stats["queries"] += 1
+    query_api = get_query_client().query_api()
     try:
-        window = RANGE_MAP[range]
-    except:
-        window = "1h" # Takes least data if error happens to limit crashes
+        if stream:
+            return await asyncio.wait_for(query_api.query_stream(flux, org=org), QUERY_TIMEOUT)
+        return await asyncio.wait_for(query_api.query(flux, org=org), QUERY_TIMEOUT)
+    except asyncio.TimeoutError:
+        query_stats["timeouts"] += 1
+        raise
+    except asyncio.CancelledError:
+        query_stats["cancelled"] += 1
+        raise
+    except Exception:
+        query_stats["errors"] += 1
+        raise
+
 
-    client = influxdb_client.InfluxDBClient(url=url, token=token, org=org)
-    query_api = client.query_api()
+def get_query_stats():
+    """Returns query counters, for monitoring."""
+    return {**query_stats, "timeout": QUERY_TIMEOUT}
 
-    query = f'''
-        from(bucket: "{bucket}")
-            |> range(start: -{range})
-            |> filter(fn: (r) => r["_measurement"] == "TEMP" 
+
+MEASUREMENTS_FILTER = '''filter(fn: (r) => r["_measurement"] == "TEMP" 
                 or r["_measurement"] == "HUMID" 
                 or r["_measurement"] == "AIR_PRESS"
                 or r["_measurement"] == "AIR_QUAL"
@@ -130,42 +217,209 @@ def get_plant_simple_history(thingy_id, range):
                 or r["_measurement"] == "INFRARED"
                 or r["_measurement"] == "RED"
                 or r["_measurement"] == "RSRP"
-                )
-            |> filter(fn: (r) => r["location"] == "{thingy_id}")
-            |> aggregateWindow(every: {window}, fn: mean, createEmpty: false)
+                )'''
+
+
+def source_query(source, field, thingy_ids, start, stop=None):
+    """Returns the Flux reading a field of plants' series between start and
+    stop (unix timestamps in seconds, stop None = now)."""
+    stop_range = f", stop: {to_rfc3339(stop)}" if stop is not None else ""
+    # Equality filters (unlike contains()) are pushed down to the storage engine
+    locations = "\n                or ".join(f'r["location"] == "{thingy_id}"' for thingy_id in thingy_ids)
+    return f'''from(bucket: "{source}")
+            |> range(start: {to_rfc3339(start)}{stop_range})
+            |> filter(fn: (r) => r["_field"] == "{field}")
+            |> {MEASUREMENTS_FILTER}
+            |> filter(fn: (r) => {locations})'''
+
+
+def history_query(thingy_ids, window, start, stop=None):
+    """Returns the Flux query of the history of plants between start and stop
+    (unix timestamps in seconds, stop None = now), aggregated in windows of
+    window seconds. Reads the coarsest rollup bucket matching the window if any
+    (see influx_rollup), and the raw bucket for the recent part not rolled up yet."""
+    start = int(start)
+    stop = int(stop) if stop is not None else None
+    now = time.time()
+
+    sources = []
+    rollup = rollups.source_for(window, now - start) if rollups is not None else None
+    if rollup is not None:
+        # Start of the last window not written by the rollup task yet
+        covered = int(now - parse_duration(rollup.offset)) // rollup.every_seconds * rollup.every_seconds
+        if covered > start:
+            rollup_stop = min(covered, stop) if stop is not None else covered
+            sources.append(source_query(rollup.bucket, "mean", thingy_ids, start, rollup_stop))
+            start = covered
+    if stop is None or start < stop:
+        sources.append(source_query(bucket, "value", thingy_ids, start, stop))
+
+    if len(sources) == 1:
+        return f'''
+        {sources[0]}
+            |> aggregateWindow(every: {window}s, fn: mean, createEmpty: false)
+    '''
+    return f'''
+        union(tables: [
+            {sources[0]},
+            {sources[1]}
+        ])
+            |> group(columns: ["_measurement", "location"])
+            |> sort(columns: ["_time"])
+            |> aggregateWindow(every: {window}s, fn: mean, createEmpty: false)
     '''
+
+
+def range_window(range):
+    """Returns the aggregation window and start time (seconds) of a RANGE_MAP range."""
+    window = None
+    try:
+        window = RANGE_MAP[range]
+    except:
+        window = "1h" # Takes least data if error happens to limit crashes
+    return parse_duration(window), time.time() - parse_duration(range)
+
+
+def history_window(start, stop=None, points=HISTORY_POINTS):
+    """Returns the aggregation window (seconds) giving at most about points
+    values per series between start and stop (unix timestamps, stop None = now).
+    Raises ValueError if the span is invalid or too expensive to query.
+    Callers align start on the window (see align_start)."""
+    span = (time.time() if stop is None else stop) - start
+    if span <= 0:
+        raise ValueError("stop must be after start")
+    if not 0 < points <= HISTORY_MAX_POINTS:
+        raise ValueError(f"points must be between 1 and {HISTORY_MAX_POINTS}")
+    if span > HISTORY_MAX_SPAN:
+        raise ValueError(f"Spans longer than {HISTORY_MAX_SPAN // 86400} days are not allowed")
+
+    window = next((window for window in HISTORY_WINDOWS if window * points >= span),
+                  math.ceil(span / points / 86400) * 86400)
+    if span > HISTORY_MAX_RAW_SPAN and (rollups is None or rollups.source_for(window, time.time() - start) is None):
+        raise ValueError(f"Spans longer than {HISTORY_MAX_RAW_SPAN // 86400} days need downsampled data, "
+                         f"not available for this period")
+    return window
+
+
+def align_start(start, window):
+    """Returns start aligned on epoch like aggregateWindow windows, so that
+    the first window is not partial. Not used for RANGE_MAP ranges, whose
+    responses start at now - range."""
+    return int(start) // window * window
+
+
+async def get_plant_simple_history(thingy_id, window, start, stop=None):
+    """Returns the air pressure, temperature and humidity of a plant between
+    start and stop (see history_query).
+    :param thingy_id: id of the plant's thingy."""
     # Execute the query
-    result = query_api.query(org=org, query=query)
+    result = await query(history_query([thingy_id], window, start, stop))
 
     # Process the result into the desired format
-    data = {"labels": [], "datasets": []}
+    return reshape_history(record for table in result for record in table.records)
+
+
+async def get_plants_history(thingy_ids, window, start, stop=None):
+    """Returns the histories of several plants, read with a single query:
+    {thingy_id: history}, each history shaped like get_plant_simple_history."""
+    result = await query(history_query(thingy_ids, window, start, stop))
+
+    # Tables are grouped by measurement and location: one location per table
+    records = {thingy_id: [] for thingy_id in thingy_ids}
     for table in result:
         for record in table.records:
-            timestamp = datetime.timestamp(record["_time"])
-
-            if timestamp not in data["labels"]:
-                data["labels"].append(timestamp)
-
-            measurement = record["_measurement"]
-            measurement_label = generate_label(measurement)
-            measurement_color = generate_colors(measurement)
-            value = record["_value"]
-
-            # Find or create dataset for the measurement
-            dataset = next((d for d in data["datasets"] if d["label"] == measurement_label), None)
-            if not dataset:
-                dataset = {
-                    "label": measurement_label,
-                    "data": [],
-                    "borderColor": measurement_color,
+            records[record["location"]].append(record)
+    return {thingy_id: reshape_history(location_records) for thingy_id, location_records in records.items()}
+
+
+async def stream_plant_history(thingy_id, window, start, stop=None):
+    """Yields the history of a plant as JSON chunks (bytes), while records are
+    received, so that memory does not grow with the range. Unlike
+    get_plant_simple_history, points are not aligned on shared labels:
+    {"datasets": [{"label", "borderColor", "fill", "data": [{"x": timestamp, "y": value}]}]}
+    Records arrive table by table (one table per measurement), so each table
+    is written as one dataset."""
+    records = await query(history_query([thingy_id], window, start, stop), stream=True)
+    buffer = ['{"datasets": [']
+    buffered = 0
+    table = None
+    try:
+        async for record in records:
+            if record.table != table:
+                # New series: close the previous dataset and open a new one
+                header = json.dumps({
+                    "label": generate_label(record["_measurement"]),
+                    "borderColor": generate_colors(record["_measurement"]),
                     "fill": False,
-                }
-                data["datasets"].append(dataset)
+                })
+                buffer.append(("]}, " if table is not None else "") + header[:-1] + ', "data": [')
+                table = record.table
+            else:
+                buffer.append(", ")
+            point = f'{{"x": {json.dumps(datetime.timestamp(record["_time"]))}, "y": {json.dumps(record["_value"])}}}'
+            buffer.append(point)
+            buffered += len(point) + 2
+            if buffered >= STREAM_CHUNK_BYTES:
+                yield "".join(buffer).encode()
+                buffer = []
+                buffered = 0
+    finally:
+        # Releases the Influxdb response if the stream stops early (e.g., client disconnected)
+        await records.aclose()
+    buffer.append("]}]}" if table is not None else "]}")
+    yield "".join(buffer).encode()
 
-            # Append data point to the dataset
-            dataset["data"].append(value)
-    
-    return data
+
+def reshape_history(records):
+    """Builds chart data from Flux records: sorted "labels" (timestamps) and one
+    dataset per measurement, aligned on labels (None where a series has no value).
+    Runs in linear time using dict and set indexes.
+    :param records: iterable of records with _time, _measurement and _value."""
+    series = {} # Key= measurement, Obj= {timestamp: value}
+    timestamps = set()
+    for record in records:
+        timestamp = datetime.timestamp(record["_time"])
+        timestamps.add(timestamp)
+        series.setdefault(record["_measurement"], {})[timestamp] = record["_value"]
+
+    labels = sorted(timestamps)
+    datasets = []
+    for measurement, values in series.items():
+        datasets.append({
+            "label": generate_label(measurement),
+            "data": [values.get(timestamp) for timestamp in labels],
+            "borderColor": generate_colors(measurement),
+            "fill": False,
+        })
+    return {"labels": labels, "datasets": datasets}
+
+
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_duration(duration):
+    """Converts a simple Flux duration (e.g., "30m", "2h") to seconds."""
+    return int(duration[:-1]) * DURATION_UNITS[duration[-1]]
+
+
+def parse_time(value):
+    """Converts a unix timestamp (seconds) or an ISO 8601 date (UTC if no
+    timezone) to a unix timestamp. Raises ValueError if invalid."""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    date = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date.timestamp()
+
+
+def window_ttl(window):
+    """Seconds until the end of the current aggregation window (seconds).
+    Windows are aligned on epoch (like aggregateWindow), so a cached
+    history is valid until a new window starts."""
+    return window - time.time() % window
 
 
 def generate_label(measurement):
@@ -0,0 +1,174 @@
+"""
+Downsampled copies of the thingy data bucket, for long history ranges.
+
+Each rollup is a bucket ({bucket}_{every}, e.g., thingy-data_1h) filled by an
+Influxdb task with the mean, min and max of each series per window (fields
+"mean", "min" and "max", timestamped at the window start). Buckets and tasks
+are created (or updated) at startup. A new rollup bucket is first backfilled
+from the raw bucket, day by day, and only used once the backfill is done
+(marked in the bucket description, so that it survives restarts).
+Created on: 18 october 2026
+"""
+
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+from influxdb_client import BucketRetentionRules, TaskCreateRequest
+
+FIELDS = ["mean", "min", "max"]
+READY = "ready"
+BACKFILLING = "backfilling"
+
+ROLLUP_FLUX = '''data = from(bucket: "{source}")
+    |> range(start: {start}, stop: {stop})
+    |> filter(fn: (r) => r["_field"] == "value")
+'''
+FIELD_FLUX = '''data
+    |> aggregateWindow(every: {every}, fn: {field}, createEmpty: false, timeSrc: "_start")
+    |> set(key: "_field", value: "{field}")
+    |> to(bucket: "{target}", org: "{org}")
+'''
+TASK_OPTION = 'option task = {{name: "{name}", every: {every}, offset: {offset}}}\n\n'
+
+
+class Rollup:
+    """A rollup bucket, with its window and retention (seconds, 0 = forever)."""
+
+    def __init__(self, every, every_seconds, retention_seconds, offset="1m"):
+        self.every = every
+        self.every_seconds = every_seconds
+        self.retention_seconds = retention_seconds
+        self.offset = offset
+        self.bucket = None # Name, set by RollupManager
+        self.ready = False
+
+
+# Default rollups: 1m kept 7 days, 10m kept 90 days, 1h kept forever
+DEFAULT_ROLLUPS = [
+    Rollup("1m", 60, 7 * 86400),
+    Rollup("10m", 600, 90 * 86400),
+    Rollup("1h", 3600, 0),
+]
+
+
+class RollupManager:
+    """Provisions rollup buckets and tasks, and picks the rollup to read."""
+
+    def __init__(self, client, bucket, org, rollups=None, backfill_seconds=30 * 86400):
+        self.client = client
+        self.bucket = bucket
+        self.org = org
+        self.rollups = rollups if rollups is not None else DEFAULT_ROLLUPS
+        self.backfill_seconds = backfill_seconds
+        for rollup in self.rollups:
+            rollup.bucket = f"{bucket}_{rollup.every}"
+        self._thread = None
+        self._stats = {"provisioned": False, "backfilled_days": 0, "errors": 0}
+
+    def provision(self):
+        """Creates or updates rollup buckets and tasks (blocking), then
+        backfills new buckets in a background thread. Errors are logged:
+        history queries then use the raw bucket."""
+        pending = []
+        for rollup in self.rollups:
+            try:
+                bucket = self._ensure_bucket(rollup)
+                self._ensure_task(rollup)
+                rollup.ready = bucket.description == READY
+                if not rollup.ready:
+                    pending.append((rollup, bucket))
+            except Exception as e:
+                self._stats["errors"] += 1
+                logging.error(f"Could not provision rollup {rollup.bucket}: {e}")
+        self._stats["provisioned"] = True
+        if pending:
+            self._thread = threading.Thread(target=self._backfill, args=(pending,),
+                                            name="influx-rollup-backfill", daemon=True)
+            self._thread.start()
+
+    def source_for(self, window_seconds, range_seconds):
+        """Returns the coarsest ready rollup whose window divides the requested
+        aggregation window and whose retention covers the range, or None (raw bucket)."""
+        best = None
+        for rollup in self.rollups:
+            if not rollup.ready or window_seconds % rollup.every_seconds:
+                continue
+            if rollup.retention_seconds and rollup.retention_seconds < range_seconds:
+                continue
+            if best is None or rollup.every_seconds > best.every_seconds:
+                best = rollup
+        return best
+
+    def stats(self):
+        """Returns rollup states, for monitoring."""
+        return {**self._stats, "ready": [rollup.bucket for rollup in self.rollups if rollup.ready]}
+
+    def task_flux(self, rollup):
+        """Returns the Flux of the task filling a rollup. Tasks run once per
+        window (now() is then the scheduled time, aligned on the window) and
+        rewrite the previous window too, for points received late."""
+        lookback = f"-{2 * rollup.every_seconds}s"
+        return (TASK_OPTION.format(name=f"rollup {rollup.bucket}", every=rollup.every, offset=rollup.offset)
+                + self._rollup_flux(rollup, lookback, "now()"))
+
+    def _rollup_flux(self, rollup, start, stop):
+        return ROLLUP_FLUX.format(source=self.bucket, start=start, stop=stop) + "\n".join(
+            FIELD_FLUX.format(every=rollup.every, field=field, target=rollup.bucket, org=self.org)
+            for field in FIELDS)
+
+    def _ensure_bucket(self, rollup):
+        buckets_api = self.client.buckets_api()
+        bucket = buckets_api.find_bucket_by_name(rollup.bucket)
+        if bucket is None:
+            retention_rules = None
+            if rollup.retention_seconds:
+                retention_rules = BucketRetentionRules(type="expire", every_seconds=rollup.retention_seconds)
+            bucket = buckets_api.create_bucket(bucket_name=rollup.bucket, retention_rules=retention_rules,
+                                               description=BACKFILLING, org=self.org)
+            logging.info(f"Created rollup bucket {rollup.bucket}.")
+        return bucket
+
+    def _ensure_task(self, rollup):
+        tasks_api = self.client.tasks_api()
+        name = f"rollup {rollup.bucket}"
+        flux = self.task_flux(rollup)
+        tasks = tasks_api.find_tasks(name=name)
+        if not tasks:
+            tasks_api.create_task(task_create_request=TaskCreateRequest(
+                org=self.org, flux=flux, status="active", description=f"Downsampling of {self.bucket}"))
+            logging.info(f"Created rollup task {name}.")
+        elif tasks[0].flux != flux:
+            tasks[0].flux = flux
+            tasks_api.update_task(tasks[0])
+            logging.info(f"Updated rollup task {name}.")
+
+    def _backfill(self, pending):
+        """Writes rollups of the past days (up to the retention), one day per query."""
+        query_api = self.client.query_api()
+        for rollup, bucket in pending:
+            days = self.backfill_seconds
+            if rollup.retention_seconds:
+                days = min(days, rollup.retention_seconds)
+            days = days // 86400
+            # Up to the last complete window, later windows are written by the task
+            end = int(time.time()) // rollup.every_seconds * rollup.every_seconds
+            try:
+                for day in range(days, 0, -1):
+                    start = end - day * 86400
+                    stop = min(start + 86400, end)
+                    query_api.query(self._rollup_flux(rollup, to_rfc3339(start), to_rfc3339(stop)), org=self.org)
+                    self._stats["backfilled_days"] += 1
+                bucket.description = READY
+                self.client.buckets_api().update_bucket(bucket)
+                rollup.ready = True
+                logging.info(f"Backfilled rollup bucket {rollup.bucket}.")
+            except Exception as e:
+                self._stats["errors"] += 1
+                logging.error(f"Backfill of rollup {rollup.bucket} failed, retried at next start: {e}")
+
+
+def to_rfc3339(timestamp):
+    """Returns a Flux time literal of a unix timestamp (seconds)."""
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
@@ -0,0 +1,133 @@
+"""
+On-disk spool for Influxdb records that could not be written.
+Records are appended, in line protocol, to one segment file per time window
+and replayed in order (oldest segment first) once Influxdb is available again.
+Created on: 18 october 2026
+"""
+
+import logging
+import os
+import threading
+import time
+
+SEGMENT_SUFFIX = ".lp"
+# A segment being replayed is renamed, so that new records go to a new file.
+REPLAY_SUFFIX = ".replay"
+
+
+class Spool:
+    """Append-only segment files with a total size limit.
+    When the limit is exceeded, oldest segments are evicted first."""
+
+    def __init__(self, directory, segment_seconds=300, max_bytes=512 * 1024 * 1024):
+        self.directory = directory
+        self.segment_seconds = segment_seconds
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._stats = {"spooled": 0, "replayed": 0, "evicted_segments": 0, "evicted_records": 0}
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            self._bytes = sum(os.path.getsize(path) for path in self._segments())
+
+    def append(self, records):
+        """Appends line protocol records to the current segment."""
+        if not records:
+            return
+        window = int(time.time()) // self.segment_seconds * self.segment_seconds
+        path = os.path.join(self.directory, f"{window:012d}{SEGMENT_SUFFIX}")
+        data = "".join(record + "\n" for record in records)
+        with self._lock:
+            with open(path, "a") as file:
+                file.write(data)
+            self._bytes += len(data.encode())
+            self._stats["spooled"] += len(records)
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def replay(self, write, batch_size):
+        """Replays the oldest segment with write(records), batch by batch.
+        The segment is deleted once fully written. If write() raises, records
+        not written yet are kept for the next replay and False is returned."""
+        with self._lock:
+            segments = self._segments()
+            if not segments:
+                self._bytes = 0 # Replayed by another process sharing the directory
+                return True
+            path = segments[0]
+            try:
+                if path.endswith(SEGMENT_SUFFIX):
+                    replay_path = path[:-len(SEGMENT_SUFFIX)] + REPLAY_SUFFIX
+                    os.replace(path, replay_path)
+                    path = replay_path
+                with open(path) as file:
+                    records = file.read().splitlines()
+            except FileNotFoundError:
+                # Segment taken by another process sharing the directory
+                self._bytes = sum(os.path.getsize(path) for path in self._segments())
+                return True
+
+        written = 0
+        try:
+            while written < len(records):
+                write(records[written:written + batch_size])
+                written = min(written + batch_size, len(records))
+        except Exception as e:
+            logging.warning(f"Influxdb spool replay interrupted: {e}")
+            self._rewrite(path, records[written:])
+            return False
+        finally:
+            with self._lock:
+                self._stats["replayed"] += written
+
+        with self._lock:
+            if os.path.exists(path):
+                self._remove(path)
+        return True
+
+    def is_empty(self):
+        with self._lock:
+            return self._bytes == 0
+
+    def stats(self):
+        """Returns spool counters, for monitoring."""
+        with self._lock:
+            return {**self._stats, "segments": len(self._segments()),
+                    "bytes": self._bytes, "max_bytes": self.max_bytes}
+
+    def _segments(self):
+        """Must be called with the lock held. Returns segment paths, oldest first.
+        A segment being replayed comes before a new segment of the same window."""
+        names = [name for name in os.listdir(self.directory)
+                 if name.endswith(SEGMENT_SUFFIX) or name.endswith(REPLAY_SUFFIX)]
+        names.sort(key=lambda name: (name.split(".")[0], not name.endswith(REPLAY_SUFFIX)))
+        return [os.path.join(self.directory, name) for name in names]
+
+    def _rewrite(self, path, records):
+        """Atomically replaces a replayed segment by the records left to write."""
+        with self._lock:
+            if not os.path.exists(path):
+                return # Evicted meanwhile
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w") as file:
+                file.write("".join(record + "\n" for record in records))
+            self._bytes += os.path.getsize(tmp_path) - os.path.getsize(path)
+            os.replace(tmp_path, path)
+
+    def _evict(self):
+        """Must be called with the lock held. Deletes oldest segments until
+        the spool fits in max_bytes (the newest segment is always kept)."""
+        for path in self._segments()[:-1]:
+            if self._bytes <= self.max_bytes:
+                break
+            with open(path) as file:
+                evicted_records = sum(1 for _ in file)
+            self._remove(path)
+            self._stats["evicted_segments"] += 1
+            self._stats["evicted_records"] += evicted_records
+            logging.warning(f"Influxdb spool full, evicted segment {path}")
+
+    def _remove(self, path):
+        """Must be called with the lock held."""
+        self._bytes -= os.path.getsize(path)
+        os.remove(path)
@@ -0,0 +1,216 @@
+"""
+Batching write pipeline for Influxdb.
+Points are queued in a bounded in-memory buffer and written in batches
+by a background thread, so callers (e.g., MQTT messages) never wait for Influxdb.
+With a spool, records that cannot be written are kept on disk and replayed later.
+Created on: 18 october 2026
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+
+from influxdb_client.client.write_api import SYNCHRONOUS
+
+
+class BatchWriter:
+    """Writes line protocol records to an Influxdb bucket in batches.
+
+    A batch is written when batch_size records are buffered or flush_interval
+    seconds after the previous write. Failed writes are retried with an
+    exponential backoff.
+
+    Without spool, failed batches are dropped, as well as oldest records when
+    the buffer is full. With a spool (see influx_spool.Spool), failed batches
+    and records not fitting in the buffer are spooled. Influxdb is then
+    considered down, new batches go straight to the spool until a ping
+    succeeds, and the spool is replayed while the buffer is not backlogged."""
+
+    def __init__(self, client, bucket, org, batch_size=1000, flush_interval=1.0,
+                 buffer_size=100000, max_retries=5, retry_interval=1.0, max_retry_delay=30.0,
+                 spool=None, health_check_interval=10.0):
+        self.client = client
+        self.bucket = bucket
+        self.org = org
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.max_retries = max_retries
+        self.retry_interval = retry_interval
+        self.max_retry_delay = max_retry_delay
+        self.spool = spool
+        self.health_check_interval = health_check_interval
+
+        self._buffer = deque()
+        self._cond = threading.Condition()
+        self._closed = threading.Event()
+        self._thread = None
+        self._healthy = True
+        self._next_health_check = 0.0
+        self._next_replay = 0.0
+        self._stats = {"enqueued": 0, "written": 0, "dropped": 0, "spooled": 0,
+                       "batches": 0, "failed_batches": 0, "retries": 0}
+
+    def enqueue(self, records, block=False):
+        """Adds line protocol records to the buffer. Never waits for Influxdb,
+        unless block is True: then waits for free space in the buffer instead
+        of spooling or dropping records (used for bulk replays)."""
+        overflow = []
+        with self._cond:
+            if self._thread is None:
+                self._start()
+            for record in records:
+                if block:
+                    while len(self._buffer) >= self.buffer_size and not self._closed.is_set():
+                        self._cond.notify_all()
+                        self._cond.wait()
+                if len(self._buffer) >= self.buffer_size:
+                    if self.spool is not None:
+                        overflow.append(record)
+                        continue
+                    self._buffer.popleft()
+                    self._stats["dropped"] += 1
+                self._buffer.append(record)
+            self._stats["enqueued"] += len(records)
+            if len(self._buffer) >= self.batch_size:
+                self._cond.notify()
+        if overflow:
+            self._to_spool(overflow)
+
+    def close(self, timeout=10):
+        """Writes remaining records once (spooled on failure) and stops the writer thread."""
+        self._closed.set()
+        with self._cond:
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def stats(self):
+        """Returns writer counters, for monitoring."""
+        with self._cond:
+            return {**self._stats, "buffered": len(self._buffer), "buffer_size": self.buffer_size,
+                    "healthy": self._healthy}
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name="influx-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        write_api = self.client.write_api(write_options=SYNCHRONOUS)
+        while True:
+            try:
+                batch = self._next_batch()
+                if batch:
+                    self._write(write_api, batch)
+                elif self._closed.is_set():
+                    return
+                if self.spool is not None and not self._closed.is_set():
+                    self._replay_spool(write_api)
+            except Exception as e:
+                # Nothing restarts this thread: unexpected errors must not stop it
+                logging.error(f"Influxdb writer error: {e}")
+                self._closed.wait(self.retry_interval)
+
+    def _next_batch(self):
+        """Waits for a full batch or for the flush interval, then takes up to
+        batch_size records from the buffer."""
+        deadline = time.monotonic() + self.flush_interval
+        with self._cond:
+            while len(self._buffer) < self.batch_size and not self._closed.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            count = min(self.batch_size, len(self._buffer))
+            batch = [self._buffer.popleft() for _ in range(count)]
+            self._cond.notify_all() # Wakes up blocked enqueue() calls
+            return batch
+
+    def _write(self, write_api, batch):
+        """Writes one batch, retrying with exponential backoff.
+        Returns False if the batch could not be written."""
+        if self.spool is not None and not self._healthy and not self._check_health():
+            # Influxdb is down, don't wait for retries
+            self._to_spool(batch)
+            return False
+
+        delay = self.retry_interval
+        attempt = 0
+        while True:
+            try:
+                write_api.write(bucket=self.bucket, org=self.org, record=batch)
+                with self._cond:
+                    self._stats["written"] += len(batch)
+                    self._stats["batches"] += 1
+                return True
+            except Exception as e:
+                attempt += 1
+                if attempt > self.max_retries or self._closed.is_set():
+                    with self._cond:
+                        self._stats["failed_batches"] += 1
+                    if self.spool is not None:
+                        logging.error(f"Influxdb batch of {len(batch)} records spooled: {e}")
+                        self._healthy = False
+                        self._next_health_check = time.monotonic() + self.health_check_interval
+                        self._to_spool(batch)
+                    else:
+                        logging.error(f"Influxdb batch of {len(batch)} records dropped: {e}")
+                        with self._cond:
+                            self._stats["dropped"] += len(batch)
+                    return False
+                logging.warning(f"Influxdb write failed, retrying in {delay}s: {e}")
+                with self._cond:
+                    self._stats["retries"] += 1
+                # Interrupted on close, remaining records are then written once
+                self._closed.wait(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+
+    def _replay_spool(self, write_api):
+        """Replays one spooled segment if Influxdb is up and the buffer is not backlogged."""
+        if self.spool.is_empty() or time.monotonic() < self._next_replay:
+            return
+        if not self._healthy and not self._check_health():
+            return
+        with self._cond:
+            if len(self._buffer) >= self.batch_size:
+                return
+
+        def write(records):
+            write_api.write(bucket=self.bucket, org=self.org, record=records)
+
+        try:
+            replayed = self.spool.replay(write, self.batch_size)
+        except OSError as e:
+            # Spool files can't be read or written (e.g., disk full): retried later
+            logging.error(f"Influxdb spool replay failed: {e}")
+            self._next_replay = time.monotonic() + self.health_check_interval
+            return
+        if not replayed:
+            self._healthy = False
+            self._next_health_check = time.monotonic() + self.health_check_interval
+
+    def _check_health(self):
+        """Pings Influxdb, at most once every health_check_interval seconds."""
+        now = time.monotonic()
+        if now < self._next_health_check:
+            return False
+        self._next_health_check = now + self.health_check_interval
+        try:
+            self._healthy = self.client.ping()
+        except Exception:
+            self._healthy = False
+        if self._healthy:
+            logging.info("Influxdb is available again, replaying spooled records.")
+        return self._healthy
+
+    def _to_spool(self, records):
+        try:
+            self.spool.append(records)
+            with self._cond:
+                self._stats["spooled"] += len(records)
+        except Exception as e:
+            logging.error(f"Influxdb spool failed, {len(records)} records dropped: {e}")
+            with self._cond:
+                self._stats["dropped"] += len(records)
@@ -0,0 +1,160 @@
+"""
+Ingestion pipeline between the MQTT network thread and worker threads.
+Messages are put in bounded queues and processed by a pool of workers,
+so that the paho network loop never waits for databases.
+Created on: 18 october 2026
+"""
+
+import json
+import logging
+import os
+import threading
+import zlib
+from collections import deque
+
+# What to do when a worker queue is full:
+# - "block": the MQTT thread waits for free space (the broker buffers messages)
+# - "drop-oldest": the oldest queued message is dropped
+# - "spill": messages are appended to a file on disk, and processed later
+BACKPRESSURE_POLICIES = ("block", "drop-oldest", "spill")
+
+
+class IngestPipeline:
+    """Bounded queues processed by worker threads.
+    All messages with the same key (thingy id) go to the same worker,
+    so they are processed in order."""
+
+    def __init__(self, handler, workers=4, queue_size=10000, policy="block", spill_dir=None):
+        if policy not in BACKPRESSURE_POLICIES:
+            raise ValueError(f"Unknown backpressure policy {policy}, use one of {BACKPRESSURE_POLICIES}")
+        if policy == "spill" and not spill_dir:
+            raise ValueError("A spill directory is required with the spill policy")
+
+        self.handler = handler
+        self.policy = policy
+        self.queue_size = queue_size
+        self._shards = [_Shard(i, queue_size, spill_dir if policy == "spill" else None)
+                        for i in range(workers)]
+        self._stopped = False
+
+    def start(self):
+        for shard in self._shards:
+            shard.thread = threading.Thread(target=self._work, args=(shard,),
+                                            name=f"ingest-{shard.index}", daemon=True)
+            shard.thread.start()
+
+    def submit(self, key, item):
+        """Queues an item (JSON serializable) for the worker of this key.
+        Only waits if the queue is full and the policy is "block"."""
+        shard = self._shards[zlib.crc32(key.encode()) % len(self._shards)]
+        with shard.cond:
+            shard.stats["submitted"] += 1
+            if shard.spilled:
+                # Keep order: once spilling, spill until the file is processed
+                shard.spill(item)
+                return
+
+            if len(shard.queue) >= self.queue_size:
+                if self.policy == "block":
+                    shard.stats["blocked"] += 1
+                    while len(shard.queue) >= self.queue_size and not self._stopped:
+                        shard.cond.wait()
+                elif self.policy == "drop-oldest":
+                    shard.queue.popleft()
+                    shard.stats["dropped"] += 1
+                else:
+                    shard.spill(item)
+                    shard.cond.notify_all()
+                    return
+
+            shard.queue.append(item)
+            shard.stats["max_depth"] = max(shard.stats["max_depth"], len(shard.queue))
+            shard.cond.notify_all()
+
+    def stop(self, timeout=10):
+        """Processes queued messages and stops workers.
+        Spilled messages stay on disk and are processed on next start."""
+        self._stopped = True
+        for shard in self._shards:
+            with shard.cond:
+                shard.cond.notify_all()
+        for shard in self._shards:
+            if shard.thread is not None:
+                shard.thread.join(timeout)
+
+    def stats(self):
+        """Returns queue depths and counters, for monitoring."""
+        workers = []
+        for shard in self._shards:
+            with shard.cond:
+                workers.append({**shard.stats, "depth": len(shard.queue), "spilled": shard.spilled})
+        totals = {name: sum(worker[name] for worker in workers)
+                  for name in ("submitted", "processed", "failed", "dropped", "blocked", "depth", "spilled")}
+        return {**totals, "policy": self.policy, "queue_size": self.queue_size, "workers": workers}
+
+    def _work(self, shard):
+        while True:
+            with shard.cond:
+                while not shard.queue and not shard.spilled and not self._stopped:
+                    shard.cond.wait()
+                if not shard.queue and shard.spilled and not self._stopped:
+                    shard.unspill()
+                if not shard.queue:
+                    return # Stopped and queue drained
+                item = shard.queue.popleft()
+                shard.cond.notify_all() # Wakes up a blocked submit
+
+            try:
+                self.handler(*item)
+                shard.stats["processed"] += 1
+            except Exception as e:
+                shard.stats["failed"] += 1
+                logging.error(f"Error when processing message: {e}")
+
+
+class _Shard:
+    """Queue of one worker, with its optional spill file (one JSON item per line)."""
+
+    def __init__(self, index, queue_size, spill_dir):
+        self.index = index
+        self.queue_size = queue_size
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.thread = None
+        self.stats = {"submitted": 0, "processed": 0, "failed": 0, "dropped": 0,
+                      "blocked": 0, "max_depth": 0}
+
+        self.spilled = 0 # Items in the spill file, not queued yet
+        self.spill_path = None
+        self.spill_offset = 0
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+            self.spill_path = os.path.join(spill_dir, f"worker-{index}.jsonl")
+            if os.path.exists(self.spill_path):
+                # Left by a previous run
+                with open(self.spill_path) as file:
+                    self.spilled = sum(1 for _ in file)
+
+    def spill(self, item):
+        """Must be called with the lock held."""
+        with open(self.spill_path, "a") as file:
+            file.write(json.dumps(item) + "\n")
+        self.spilled += 1
+
+    def unspill(self):
+        """Must be called with the lock held. Moves up to queue_size
+        spilled items into the queue."""
+        with open(self.spill_path) as file:
+            file.seek(self.spill_offset)
+            for _ in range(min(self.queue_size, self.spilled)):
+                line = file.readline()
+                if not line:
+                    self.spilled = 0 # Truncated file
+                    break
+                self.queue.append(tuple(json.loads(line)))
+                self.spilled -= 1
+            self.spill_offset = file.tell()
+
+        if not self.spilled:
+            os.remove(self.spill_path)
+            self.spill_offset = 0
@@ -0,0 +1,132 @@
+"""
+Thread safe store of the latest sensor values of each thingy.
+Written by MQTT workers, read by API handlers.
+Created on: 18 october 2026
+"""
+
+import json
+import threading
+import time
+import uuid
+
+
+class LatestStore:
+    """Latest value and reception time of every key of every thingy.
+
+    Each update increments a global version, also kept by the updated
+    thingy, so that readers can cheaply check what changed since a version.
+    Snapshots are plain dicts built lazily and reused until the next change:
+    callers must not modify them. The JSON encoding of the snapshot is
+    cached the same way, with an ETag made of the version."""
+
+    def __init__(self):
+        self._records = {} # Key= thingy id, Obj= _ThingyRecord
+        self._lock = threading.Lock()
+        self._version = 0
+        self._snapshot = {}
+        self._snapshot_version = 0
+        self._changed = set() # Thingy ids updated since the last snapshot
+        self._json = None # (version, etag, body)
+        # Versions restart at 0 with the process: ETags must differ between runs
+        self._etag_prefix = uuid.uuid4().hex[:8]
+
+    @property
+    def version(self):
+        return self._version
+
+    def update(self, thingy_id, changes, timestamp=None):
+        """Stores changed values ({key: value}) of a thingy. Returns the new version."""
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            record = self._records.get(thingy_id)
+            if record is None:
+                record = _ThingyRecord()
+                self._records[thingy_id] = record
+            for key, value in changes.items():
+                sensor_value = record.values.get(key)
+                if sensor_value is None:
+                    record.values[key] = _SensorValue(value, timestamp)
+                else:
+                    sensor_value.value = value
+                    sensor_value.updated_at = timestamp
+            self._version += 1
+            record.version = self._version
+            record.snapshot = None
+            self._changed.add(thingy_id)
+            return self._version
+
+    def get(self, thingy_id):
+        """Returns the snapshot of a thingy, or None if it never sent data."""
+        with self._lock:
+            record = self._records.get(thingy_id)
+            return record.get_snapshot() if record is not None else None
+
+    def snapshot(self):
+        """Returns {thingy_id: snapshot} of all thingys.
+        Only thingys updated since the previous snapshot are rebuilt: the
+        previous dict (still used by readers) is copied and these entries replaced."""
+        with self._lock:
+            return self._get_snapshot()
+
+    def snapshot_json(self):
+        """Returns (etag, body) of the JSON encoded snapshot of all thingys."""
+        with self._lock:
+            version = self._version
+            if self._json is not None and self._json[0] == version:
+                return self._json[1], self._json[2]
+            snapshot = self._get_snapshot()
+        # Encoded without the lock (snapshots are not modified), so writers don't wait
+        body = json.dumps(snapshot).encode()
+        etag = f'"{self._etag_prefix}-{version}"'
+        with self._lock:
+            if self._json is None or self._json[0] < version:
+                self._json = (version, etag, body)
+        return etag, body
+
+    def changed_since(self, version):
+        """Returns {thingy_id: snapshot} of thingys updated after version."""
+        with self._lock:
+            return {thingy_id: record.get_snapshot() for thingy_id, record in self._records.items()
+                    if record.version > version}
+
+    def stats(self):
+        """Returns store counters, for monitoring."""
+        with self._lock:
+            return {"thingys": len(self._records), "version": self._version}
+
+    def _get_snapshot(self):
+        """Must be called with the lock held."""
+        if self._snapshot_version != self._version:
+            snapshot = dict(self._snapshot)
+            for thingy_id in self._changed:
+                snapshot[thingy_id] = self._records[thingy_id].get_snapshot()
+            self._changed.clear()
+            self._snapshot = snapshot
+            self._snapshot_version = self._version
+        return self._snapshot
+
+
+class _ThingyRecord:
+    __slots__ = ("values", "version", "snapshot")
+
+    def __init__(self):
+        self.values = {} # Key= key (e.g., humidity), Obj= _SensorValue
+        self.version = 0
+        self.snapshot = None # Built on first read after a change
+
+    def get_snapshot(self):
+        """Must be called with the store lock held.
+        Returns {key: value, ..., "updated_at": {key: unix timestamp}}."""
+        if self.snapshot is None:
+            self.snapshot = {key: sensor_value.value for key, sensor_value in self.values.items()}
+            self.snapshot["updated_at"] = {key: sensor_value.updated_at for key, sensor_value in self.values.items()}
+        return self.snapshot
+
+
+class _SensorValue:
+    __slots__ = ("value", "updated_at")
+
+    def __init__(self, value, updated_at):
+        self.value = value
+        self.updated_at = updated_at
@@ -0,0 +1,203 @@
+"""
+Live push of latest thingy data to browsers over a websocket (/api/live),
+instead of polling /api/thingy.
+
+Protocol (JSON messages):
+- server -> client: {"type": "snapshot", "data": {thingy_id: {key: value}}}
+  with the latest data of subscribed thingys, then
+  {"type": "update", "data": {thingy_id: {key: value}}} with changed keys only.
+- client -> server: {"subscribe": [thingy_id, ...]}, {"unsubscribe": [...]}.
+  Clients are subscribed to ?ids=orange-1,orange-2 when connecting, or to all
+  thingys without ids (until they send a subscribe or unsubscribe message).
+Created on: 18 october 2026
+"""
+
+import asyncio
+import json
+import logging
+import threading
+import time
+from os import getenv
+
+from aiohttp import WSMsgType, web
+from dotenv import load_dotenv
+
+# take environment variables from api.env
+load_dotenv(dotenv_path='environments/api.env')
+
+
+class LiveHub:
+    """Fans out latest data changes to websocket clients.
+
+    publish() can be called from any thread: changes are merged and handed to
+    the event loop once per loop iteration. Each client receives at most
+    max_rate updates per second (changes in between are coalesced). A client
+    not reading fast enough (a send taking more than send_timeout seconds) is
+    disconnected."""
+
+    def __init__(self, max_rate=2.0, send_timeout=5.0, heartbeat=30.0):
+        self.max_rate = max_rate
+        self.send_timeout = send_timeout
+        self.heartbeat = heartbeat
+
+        self._loop = None
+        self._clients = set()
+        self._pending = {} # Key= thingy id, Obj= {key: value} changed since last dispatch
+        self._lock = threading.Lock()
+        self._scheduled = False
+        self._stats = {"published": 0, "dispatches": 0, "pushes": 0, "slow_consumers": 0, "connections": 0}
+
+    def start(self, loop):
+        """Sets the event loop of websocket clients (called at startup)."""
+        self._loop = loop
+
+    def publish(self, thingy_id, changes):
+        """Queues changed keys of a thingy for subscribed clients. Thread safe."""
+        if self._loop is None:
+            return
+        with self._lock:
+            self._pending.setdefault(thingy_id, {}).update(changes)
+            self._stats["published"] += 1
+            if self._scheduled:
+                return
+            self._scheduled = True
+        try:
+            self._loop.call_soon_threadsafe(self._dispatch)
+        except RuntimeError:
+            pass # Event loop closed (shutdown)
+
+    async def handle(self, request, get_snapshot):
+        """Serves a websocket connection until the client disconnects.
+        :param get_snapshot: function returning the latest data of all thingys."""
+        ws = web.WebSocketResponse(heartbeat=self.heartbeat)
+        await ws.prepare(request)
+
+        ids = request.query.get("ids")
+        client = _LiveClient(ws, {thingy_id for thingy_id in ids.split(",") if thingy_id} if ids else None)
+        self._clients.add(client)
+        self._stats["connections"] += 1
+        sender = asyncio.create_task(self._send_updates(client))
+
+        # Tokens are only checked when connecting: close the connection when it expires
+        expiry = None
+        exp = request.get("token_info", {}).get("exp")
+        if exp is not None:
+            expiry = asyncio.get_running_loop().call_later(
+                max(exp - time.time(), 0), lambda: asyncio.ensure_future(ws.close(code=4001, message=b"Token expired")))
+
+        try:
+            await self._send(client, "snapshot", client.select(get_snapshot()))
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+                try:
+                    command = json.loads(msg.data)
+                    subscribe, unsubscribe = command.get("subscribe", []), command.get("unsubscribe", [])
+                    if not isinstance(subscribe, list) or not isinstance(unsubscribe, list):
+                        raise ValueError
+                except (ValueError, AttributeError):
+                    await ws.send_json({"type": "error", "message": "Invalid message"})
+                    continue
+                if subscribe:
+                    client.subscribe(subscribe)
+                    await self._send(client, "snapshot", client.select(get_snapshot(), subscribe))
+                if unsubscribe:
+                    client.unsubscribe(unsubscribe)
+        except (asyncio.TimeoutError, ConnectionError):
+            pass # Slow consumer or connection lost, see _send
+        finally:
+            self._clients.discard(client)
+            sender.cancel()
+            if expiry is not None:
+                expiry.cancel()
+            await ws.close()
+        return ws
+
+    async def close(self):
+        """Closes all websocket connections (called at shutdown)."""
+        for client in list(self._clients):
+            await client.ws.close(code=1001, message=b"Server shutdown")
+
+    def stats(self):
+        """Returns hub counters, for monitoring."""
+        return {**self._stats, "clients": len(self._clients), "max_rate": self.max_rate}
+
+    def _dispatch(self):
+        """Runs on the event loop: merges pending changes into each client."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._scheduled = False
+        self._stats["dispatches"] += 1
+        for client in self._clients:
+            for thingy_id, changes in pending.items():
+                if client.subscribed(thingy_id):
+                    client.pending.setdefault(thingy_id, {}).update(changes)
+                    client.wakeup.set()
+
+    async def _send_updates(self, client):
+        """Pushes coalesced changes to a client, at most max_rate times per second."""
+        try:
+            while True:
+                await client.wakeup.wait()
+                # Changes received until the next allowed push are sent together
+                delay = client.last_push + 1 / self.max_rate - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                client.wakeup.clear()
+                updates, client.pending = client.pending, {}
+                if updates:
+                    await self._send(client, "update", updates)
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+
+    async def _send(self, client, type, data):
+        """Sends a message. Disconnects the client if the send times out."""
+        client.last_push = time.monotonic()
+        try:
+            await asyncio.wait_for(client.ws.send_str(json.dumps({"type": type, "data": data})), self.send_timeout)
+            self._stats["pushes"] += 1
+        except asyncio.TimeoutError:
+            self._stats["slow_consumers"] += 1
+            logging.warning("Live data client too slow, disconnected.")
+            await client.ws.close(code=1013, message=b"Too slow")
+            raise
+
+
+class _LiveClient:
+    """A websocket client with its subscriptions (None = all thingys) and the
+    changes not pushed yet."""
+
+    def __init__(self, ws, thingy_ids=None):
+        self.ws = ws
+        self.thingy_ids = thingy_ids
+        self.pending = {}
+        self.wakeup = asyncio.Event()
+        self.last_push = 0.0
+
+    def subscribed(self, thingy_id):
+        return self.thingy_ids is None or thingy_id in self.thingy_ids
+
+    def subscribe(self, thingy_ids):
+        if self.thingy_ids is None:
+            self.thingy_ids = set()
+        self.thingy_ids.update(thingy_ids)
+
+    def unsubscribe(self, thingy_ids):
+        if self.thingy_ids is None:
+            self.thingy_ids = set()
+        self.thingy_ids.difference_update(thingy_ids)
+        for thingy_id in thingy_ids:
+            self.pending.pop(thingy_id, None)
+
+    def select(self, data, thingy_ids=None):
+        """Returns the data of subscribed thingys (or of thingy_ids)."""
+        if thingy_ids is None and self.thingy_ids is None:
+            return data
+        return {thingy_id: data[thingy_id] for thingy_id in (thingy_ids or self.thingy_ids) if thingy_id in data}
+
+
+hub = LiveHub(
+    max_rate=float(getenv('LIVE_MAX_RATE', "2")),
+    send_timeout=float(getenv('LIVE_SEND_TIMEOUT', "5")),
+    heartbeat=float(getenv('LIVE_HEARTBEAT', "30")),
+)
@@ -5,12 +5,17 @@ to the app object when creating the api.
 Created by: Jean-Marie Alder on 9 november 2023
 """
 
+import asyncio
+import hashlib
 import logging
+import time
+from collections import OrderedDict
 from os import getenv
 
 import keycloak
 from aiohttp import web
 from dotenv import load_dotenv
+from jose import jwt
 
 # take environment variables from api.env
 load_dotenv(dotenv_path='environments/api.env')
@@ -20,34 +25,159 @@ client_id = getenv('KEYCLOAK_CLIENT_ID')
 realm_name = getenv('KEYCLOAK_REALM_NAME')
 client_secret_key = getenv('KEYCLOAK_SECRET_KEY')
 
+# Realm keys are kept for KEYS_TTL seconds after the last successful fetch.
+# They are refreshed in the background every KEYS_REFRESH_INTERVAL seconds,
+# so Keycloak is only needed again if it stays down longer than the TTL.
+KEYS_TTL = int(getenv('KEYCLOAK_KEYS_TTL', "3600"))
+KEYS_REFRESH_INTERVAL = int(getenv('KEYCLOAK_KEYS_REFRESH_INTERVAL', "300"))
+# Minimum delay between two refreshes triggered by requests (unknown key id
+# (kid), or expired keys), also after a failed refresh (Keycloak down).
+KEYS_MIN_REFRESH_DELAY = int(getenv('KEYCLOAK_KEYS_MIN_REFRESH_DELAY', "30"))
+# Max number of already verified tokens kept in memory.
+TOKEN_CACHE_SIZE = int(getenv('TOKEN_CACHE_SIZE', "1024"))
+# Routes accepting the token in an access_token query parameter:
+# browsers cannot set headers on websocket connections.
+TOKEN_QUERY_PATHS = {"/api/live"}
+
 # Configure client
 keycloak_openid = keycloak.KeycloakOpenID(server_url=server_url,
                                  client_id=client_id,
                                  realm_name=realm_name,
                                  client_secret_key=client_secret_key)
 
+realm_keys = {} # Key= kid, Obj= JWK (dict) of the realm signing key.
+keys_fetched_at = 0.0 # Monotonic time of the last successful fetch.
+keys_attempted_at = None # Monotonic time of the last fetch, successful or not.
+keys_lock = asyncio.Lock()
+
+# LRU of verified tokens. Key= sha256 of the token, Obj= (exp, token claims).
+token_cache = OrderedDict()
+token_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+
 @web.middleware
 async def keycloak_middleware(request: web.Request, handler):
     """Middleware for authentication. Required on all routes.
-       Checks user token with Keycloak server."""
+       Checks user token locally against the cached realm keys.
+       Token claims are available to handlers in request["token_info"]."""
     # Get the access token from the request headers
     access_token = request.headers.get('Authorization', '').replace('Bearer ', '')
+    if not access_token and request.path in TOKEN_QUERY_PATHS:
+        access_token = request.query.get('access_token', '')
     try:
-        # Validate the access token with Keycloak
-        # Decode Token
-        KEYCLOAK_PUBLIC_KEY = "-----BEGIN PUBLIC KEY-----\n" + keycloak_openid.public_key() + "\n-----END PUBLIC KEY-----"
-        options = {"verify_signature": True, "verify_aud": False, "verify_exp": True}
-        token_info = keycloak_openid.decode_token(access_token, key=KEYCLOAK_PUBLIC_KEY, options=options)
+        # Skip validation if this token was already verified and is not expired
+        token_hash = hashlib.sha256(access_token.encode()).hexdigest()
+        token_info = get_cached_token(token_hash)
 
+        if token_info is None:
+            # Validate the access token with the realm public key (no call to Keycloak)
+            # Decode Token
+            key = await get_signing_key(access_token)
+            if key is None and keys_expired():
+                return web.Response(text="Authentication service unavailable", status=503)
+            if key is None:
+                return web.Response(text="Access forbidden: Token validation failed", status=403)
+            options = {"verify_signature": True, "verify_aud": False, "verify_exp": True}
+            token_info = keycloak_openid.decode_token(access_token, key=key, options=options)
+            cache_token(token_hash, token_info)
+
+        request["token_info"] = token_info
         # If token validation and role checks pass, proceed with the request
         return await handler(request)
-    
-    except keycloak.exceptions.KeycloakGetError as e:
+
+    except (keycloak.exceptions.KeycloakGetError, jwt.JWTError) as e:
         # Handle token validation errors
         logging.error(e)
         return web.Response(text="Access forbidden: Token validation failed", status=403)
-    
+
     except Exception as e:
         # Handle other exceptions
         logging.error(e)
-        return web.Response(text="Internal server error", status=500)
\ No newline at end of file
+        return web.Response(text="Internal server error", status=500)
+
+
+async def get_signing_key(access_token):
+    """Returns the cached JWK matching the token "kid" header.
+    Keys are fetched again if the cache expired or if the kid is unknown
+    (key rotation on Keycloak). Returns None if no matching key is found."""
+    kid = jwt.get_unverified_header(access_token).get("kid")
+
+    if not keys_expired() and kid in realm_keys:
+        return realm_keys[kid]
+
+    # Unknown kid (rotation) or expired cache: refresh, but avoid hammering
+    # Keycloak with tokens carrying a bogus kid, or while it is down
+    # (requests fail fast until the next attempt).
+    if keys_attempted_at is None or time.monotonic() - keys_attempted_at > KEYS_MIN_REFRESH_DELAY:
+        await refresh_realm_keys()
+
+    if keys_expired():
+        logging.error("Keycloak realm keys expired and could not be refreshed.")
+        return None
+    return realm_keys.get(kid)
+
+
+async def refresh_realm_keys():
+    """Fetches realm signing keys (JWKS) from Keycloak and replaces the cache.
+    The blocking http call runs in an executor to keep the event loop free.
+    On failure, previous keys are kept until they expire."""
+    global realm_keys, keys_fetched_at, keys_attempted_at
+
+    previous_attempt = keys_attempted_at
+    async with keys_lock:
+        if keys_attempted_at != previous_attempt:
+            # Another coroutine tried while we were waiting: don't wait for another timeout.
+            return
+        try:
+            loop = asyncio.get_running_loop()
+            certs = await loop.run_in_executor(None, keycloak_openid.certs)
+            keys = {key["kid"]: key for key in certs.get("keys", [])
+                    if key.get("use", "sig") == "sig"}
+            if keys:
+                realm_keys = keys
+                keys_fetched_at = time.monotonic()
+        except Exception as e:
+            logging.error(f"Error when refreshing Keycloak realm keys: {e}")
+        finally:
+            keys_attempted_at = time.monotonic()
+
+
+def keys_expired():
+    """True if realm keys were never fetched or are older than KEYS_TTL."""
+    return not realm_keys or time.monotonic() - keys_fetched_at > KEYS_TTL
+
+
+def get_cached_token(token_hash):
+    """Returns claims of an already verified token, or None if the token
+    is unknown or expired (expired entries are removed)."""
+    entry = token_cache.get(token_hash)
+    if entry is None:
+        token_cache_stats["misses"] += 1
+        return None
+
+    exp, token_info = entry
+    if exp <= time.time():
+        del token_cache[token_hash]
+        token_cache_stats["misses"] += 1
+        return None
+
+    token_cache.move_to_end(token_hash)
+    token_cache_stats["hits"] += 1
+    return token_info
+
+
+def cache_token(token_hash, token_info):
+    """Stores verified token claims until the token "exp" claim.
+    Least recently used tokens are evicted when the cache is full."""
+    if "exp" not in token_info:
+        return
+    token_cache[token_hash] = (token_info["exp"], token_info)
+    token_cache.move_to_end(token_hash)
+    while len(token_cache) > TOKEN_CACHE_SIZE:
+        token_cache.popitem(last=False)
+        token_cache_stats["evictions"] += 1
+
+
+def get_token_cache_stats():
+    """Returns token cache counters, for monitoring."""
+    return {**token_cache_stats, "size": len(token_cache), "max_size": TOKEN_CACHE_SIZE}
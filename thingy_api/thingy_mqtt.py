@@ -6,17 +6,18 @@ Updated by: LK on 20 dec 2023
 
 import json
 import logging
-import os
-import threading
-from datetime import datetime
 from os import getenv
 
 import paho.mqtt.client as mqtt
 import paho.mqtt.publish as publish
 from dotenv import load_dotenv
 import thingy_api.dal.maintenance as maintenance_dal
-from thingy_api.dal.thingy_id import add_new_id, get_all_thingy_ids, update_id
+from thingy_api.backup import BackupWriter
 from thingy_api.influx import write_point
+from thingy_api.ingest import IngestPipeline
+from thingy_api.latest import LatestStore
+from thingy_api.live import hub as live_hub
+from thingy_api.thingy_registry import register_thingy
 
 # take environment variables from api.env
 load_dotenv(dotenv_path='environments/api.env')
@@ -26,9 +27,28 @@ mqtt_port = int(getenv('MQTT_PORT', "1889"))
 mqtt_username = getenv('MQTT_USERNAME', "user")
 mqtt_password = getenv('MQTT_PASSWORD', "password")
 mqtt_topic = 'things/+/shadow/update'
-
-latest_sensor_data = { }
-
+# Message processing workers (see ingest.py)
+mqtt_workers = int(getenv('MQTT_WORKERS', "4"))
+mqtt_queue_size = int(getenv('MQTT_QUEUE_SIZE', "10000"))
+mqtt_backpressure = getenv('MQTT_BACKPRESSURE', "block")
+mqtt_spill_dir = getenv('MQTT_SPILL_DIR', "data/.mqtt_spill")
+
+mqtt_client = None
+
+# Buffered writer of backup files in data/ folder (see backup.py)
+backup_writer = BackupWriter(
+    directory="data",
+    flush_bytes=int(getenv('BACKUP_FLUSH_BYTES', str(64 * 1024))),
+    flush_interval=float(getenv('BACKUP_FLUSH_INTERVAL', "1")),
+    idle_timeout=float(getenv('BACKUP_IDLE_TIMEOUT', "300")),
+    fsync_interval=float(getenv('BACKUP_FSYNC_INTERVAL', "30")),
+    max_buffer_bytes=int(getenv('BACKUP_MAX_BUFFER_BYTES', str(16 * 1024 * 1024))),
+)
+
+# Latest values of every appId of each thingy (see latest.py)
+latest_store = LatestStore()
+
+# Keys of appIds in latest data (other appIds are kept under their own name)
 appId_map = {
     "HUMID": "humidity",
     "AIR_PRESS": "pressure",
@@ -47,10 +67,15 @@ def on_connect(client, userdata, flags, rc):
         print("Failed to connect, return code %d\n", rc) # Keep this log for container info
         logging.error("Failed to connect, return code %d\n", rc)
 
-def on_message(client, userdata, msg):  
-    data = msg.payload.decode()
+def on_message(client, userdata, msg):
+    """Runs on the paho network thread: only queues the message for a worker."""
     # retrieves thingy's ID
     thingy_id = msg.topic.split('/')[1] # Works only if id is in between first and second slash
+    ingest_pipeline.submit(thingy_id, (thingy_id, msg.payload.decode()))
+
+
+def process_message(thingy_id, data):
+    """Processes one thingy message (runs on an ingestion worker)."""
     message = json.loads(data)
 
     update_thingy_id_list(thingy_id)
@@ -60,8 +85,8 @@ def on_message(client, userdata, msg):
     else: 
         #Update real-time on FE 
         add_to_latest(message, thingy_id)
-        # Append the data to the file in a non-blocking way
-        threading.Thread(target=append_data_to_backup, args=(data, thingy_id)).start()
+        # Append the data to the backup file (buffered, written in background)
+        append_data_to_backup(data, thingy_id)
 
         if "appId" in json.loads(data) and json.loads(data)["appId"] in INFLUX_DATA_IDS:
             # Only send metric data to influx, ignore others
@@ -97,15 +122,9 @@ def publish_led_color(thingy_id, color):
 
 
 def append_data_to_backup(data, thingy_id):
-    """Writes thingy data to a backup file inside data/ folder."""
-    # Get the current date in 'yyyymmdd' format
-    current_date = datetime.now().strftime('%Y%m%d')
-    filename = f'data/{thingy_id}/{current_date}.txt'
-
-    # Create the directory if it doesn't exist
-    os.makedirs(os.path.dirname(filename), exist_ok=True)
-    with open(filename, 'a') as file:
-        file.write(data + '\n')
+    """Writes thingy data to a backup file inside data/ folder
+    (data/{thingy_id}/{yyyymmdd}.txt)."""
+    backup_writer.append(data, thingy_id)
 
 
 def start_mqtt():
@@ -113,7 +132,12 @@ def start_mqtt():
     Start mqtt server using client.loop_start() to allow multiple
     services to run.
     """
+    global mqtt_client
+
+    ingest_pipeline.start()
+
     client = mqtt.Client()
+    mqtt_client = client
 
     # set callbacks
     client.on_connect = on_connect
@@ -127,14 +151,36 @@ def start_mqtt():
 
     client.loop_start()
 
+
+def stop_mqtt():
+    """Disconnects from the broker and processes queued messages."""
+    if mqtt_client is not None:
+        mqtt_client.disconnect()
+        mqtt_client.loop_stop()
+    ingest_pipeline.stop()
+    backup_writer.close()
+
+
+def get_ingest_stats():
+    """Returns ingestion queues statistics, for monitoring."""
+    return ingest_pipeline.stats()
+
+
+def get_backup_stats():
+    """Returns backup writer statistics, for monitoring."""
+    return backup_writer.stats()
+
 def add_to_latest(msg, thingy_id):
-    #create sensor data object if thingy id unknonw
-    if thingy_id not in latest_sensor_data:
-        latest_sensor_data[thingy_id] = {}
+    """Stores the message value as latest data of the thingy
+    (the thingy is created without value if there is no appId)."""
+    if "appId" not in msg or "data" not in msg:
+        latest_store.update(thingy_id, {})
+        return
 
-    if "appId" in msg and msg["appId"] in appId_map:
-        key = appId_map[msg["appId"]]
-        latest_sensor_data[thingy_id][key] = msg["data"]
+    changes = {appId_map.get(msg["appId"], msg["appId"]): msg["data"]}
+    latest_store.update(thingy_id, changes)
+    # Push the change to websocket clients (see live.py)
+    live_hub.publish(thingy_id, changes)
 
 def send_influx(msg, thingy_id):
     """Writes thingy data to Influxdb."""
@@ -148,26 +194,27 @@ def send_influx(msg, thingy_id):
     return res
 
 def get_thingy_data():
-    """ returns the latest thingy data """
-    global latest_sensor_data
-    return latest_sensor_data
+    """ returns the latest thingy data (shared snapshot, must not be modified) """
+    return latest_store.snapshot()
+
+def get_thingy_data_json():
+    """ returns (etag, JSON body) of the latest thingy data """
+    return latest_store.snapshot_json()
 
 def get_thingy_id_data(thingy_id):
-    """ returns the latest thingy data for ID"""
-    id_data = { thingy_id: latest_sensor_data[thingy_id]}
-    return id_data
+    """ returns the latest thingy data for ID, None if unknown"""
+    data = latest_store.get(thingy_id)
+    if data is None:
+        return None
+    return { thingy_id: data }
+
+def get_latest_stats():
+    """Returns latest data store counters, for monitoring."""
+    return latest_store.stats()
 
 def update_thingy_id_list(thingy_id):
-    """Keeps track of connected thingy ids. Mainly, updates timestamp of last time
-       thingy sent data, as well as adding new thingy ids from the mqtt broker."""
-    existing = get_all_thingy_ids()
-    maintenance = maintenance_dal.get_all_maintenance_thingies()
-    if thingy_id not in existing:
-        add_new_id(thingy_id)
-    else:
-        update_id(thingy_id)
-    if thingy_id not in maintenance:
-        maintenance_dal.add_new_thingy_id(thingy_id)
+    """Keeps track of connected thingy ids (see thingy_registry)."""
+    register_thingy(thingy_id)
 
 def update_maintenance(thingy_id):
     """Updates maintenance status and timestamps."""
@@ -176,3 +223,12 @@ def update_maintenance(thingy_id):
         maintenance_dal.set_maintenance_end(thingy_id)
     else:
         maintenance_dal.set_maintenance_start(thingy_id)
+
+
+ingest_pipeline = IngestPipeline(
+    process_message,
+    workers=mqtt_workers,
+    queue_size=mqtt_queue_size,
+    policy=mqtt_backpressure,
+    spill_dir=mqtt_spill_dir,
+)
@@ -0,0 +1,99 @@
+"""
+Process-local registry of known thingy ids.
+Avoids reading thingy_id and Maintenance tables for every MQTT message:
+the database is only written when a new thingy id shows up.
+Last seen timestamps are kept in memory and flushed periodically in one query.
+Created on: 18 october 2026
+"""
+
+import logging
+import threading
+from datetime import datetime, timezone
+from os import getenv
+
+from dotenv import load_dotenv
+
+import thingy_api.dal.maintenance as maintenance_dal
+from thingy_api.dal.thingy_id import add_new_id, get_all_thingy_ids, update_ids_last_seen
+
+# take environment variables from api.env
+load_dotenv(dotenv_path='environments/api.env')
+
+# Delay between two updates of thingy_id.updated_at (seconds)
+LAST_SEEN_FLUSH_INTERVAL = int(getenv('THINGY_LAST_SEEN_FLUSH_INTERVAL', "30"))
+
+known_ids = set() # ids in public.thingy_id
+maintenance_ids = set() # ids in public."Maintenance"
+registry_loaded = False
+registry_lock = threading.Lock()
+last_seen = {} # Key= thingy id, Obj= datetime of last message, not flushed yet.
+
+
+def load_registry():
+    """Loads known thingy ids from the database (called at startup)."""
+    global registry_loaded
+
+    thingy_ids = get_all_thingy_ids()
+    maintenance_thingies = maintenance_dal.get_all_maintenance_thingies()
+    if not isinstance(thingy_ids, list) or not isinstance(maintenance_thingies, list):
+        logging.error("Thingy id registry could not be loaded.")
+        return
+
+    with registry_lock:
+        known_ids.update(thingy_ids)
+        maintenance_ids.update(maintenance_thingies)
+        registry_loaded = True
+    logging.info(f"Thingy id registry loaded with {len(known_ids)} ids.")
+
+
+def register_thingy(thingy_id):
+    """Keeps track of connected thingy ids. Mainly, updates timestamp of last time
+       thingy sent data, as well as adding new thingy ids from the mqtt broker."""
+    if not registry_loaded:
+        load_registry()
+
+    with registry_lock:
+        new_id = thingy_id not in known_ids
+        new_maintenance = thingy_id not in maintenance_ids
+        if not new_id:
+            last_seen[thingy_id] = datetime.now(timezone.utc)
+        # Reserve ids now, so that other threads don't insert them twice
+        known_ids.add(thingy_id)
+        maintenance_ids.add(thingy_id)
+
+    if new_id:
+        if add_new_id(thingy_id) is not None:
+            forget(known_ids, thingy_id) # Insert failed, retry on next message
+
+    if new_maintenance:
+        if maintenance_dal.add_new_thingy_id(thingy_id) is not None:
+            forget(maintenance_ids, thingy_id)
+
+
+def forget(ids, thingy_id):
+    with registry_lock:
+        ids.discard(thingy_id)
+
+
+def flush_last_seen():
+    """Writes pending last seen timestamps with a single bulk UPDATE.
+    On failure, timestamps are kept for the next flush."""
+    global last_seen
+
+    with registry_lock:
+        pending = last_seen
+        last_seen = {}
+    if not pending:
+        return
+
+    try:
+        failed = update_ids_last_seen(pending) is not None
+    except Exception as e:
+        logging.error(f"Error when flushing thingy last seen timestamps: {e}")
+        failed = True
+
+    if failed:
+        with registry_lock:
+            for thingy_id, seen_at in pending.items():
+                # Keep newer timestamps received meanwhile
+                last_seen.setdefault(thingy_id, seen_at)
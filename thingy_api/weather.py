@@ -4,44 +4,143 @@ Created by: JMA on 8 dec 2023
 Updated by: JMA on 19 dec 2023
 """
 
+import asyncio
 import logging
 import os
-from aiohttp import ClientSession
+import time
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
 from dotenv import load_dotenv
-from thingy_api.dal.plant import get_all_plants, get_plant
+import thingy_api.dal.aio as dal
 from thingy_api.thingy_mqtt import publish_led_color
 
 
 load_dotenv(dotenv_path='environments/api.env')
 api_key = os.getenv('WEATHER_API_KEY', "default")
-api_url = "https://api.openweathermap.org/data/2.5/"
+# Can be pointed to a local stub server for tests
+api_url = os.getenv('WEATHER_API_URL', "https://api.openweathermap.org/data/2.5/")
+# Max simultaneous requests, request timeout (seconds), and API quota (requests per minute, burst)
+WEATHER_CONCURRENCY = int(os.getenv('WEATHER_CONCURRENCY', "10"))
+WEATHER_TIMEOUT = float(os.getenv('WEATHER_TIMEOUT', "10"))
+WEATHER_RATE_LIMIT = float(os.getenv('WEATHER_RATE_LIMIT', "60"))
+WEATHER_RATE_BURST = int(os.getenv('WEATHER_RATE_BURST', "10"))
+# Plants in the same cell of a lat/lng grid share one weather request.
+# Coordinates are rounded to this number of decimals (2 = about 1 km cells).
+WEATHER_GRID_PRECISION = int(os.getenv('WEATHER_GRID_PRECISION', "2"))
 
 current_weather = {} # Stores api request. Key= plant_id, Obj= api response.
 current_light_quality = {} # Keeps track of the light quality category (0-4)
+light_quality_version = 0 # Incremented when a light quality changes
+weather_stats = {"requests": 0, "errors": 0, "timeouts": 0, "last_refresh_seconds": None, "cells": 0,
+                 "skipped_plants": 0}
+
+session = None # Shared by all weather requests, see get_session()
+
+
+class TokenBucket:
+    """Rate limiter: allows rate requests per second on average, and bursts
+    of up to capacity requests."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    async def acquire(self):
+        """Waits until a request is allowed."""
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+rate_limiter = TokenBucket(WEATHER_RATE_LIMIT / 60, WEATHER_RATE_BURST)
+
+
+def get_session():
+    """Returns the weather http session, created on first use (inside the event loop)."""
+    global session
+    if session is None:
+        session = ClientSession(connector=TCPConnector(limit=WEATHER_CONCURRENCY),
+                                timeout=ClientTimeout(total=WEATHER_TIMEOUT))
+    return session
+
+
+async def close_session():
+    global session
+    if session is not None:
+        await session.close()
+        session = None
 
 
 async def refresh_weather_info():
-    """Sets weather info to current situation using api call."""
-    global current_weather
-    plants = get_all_plants()
+    """Sets weather info to current situation using api call.
+    Plants are grouped by grid cell (see weather_cell), and cells are fetched
+    concurrently (at most WEATHER_CONCURRENCY at a time) within the API quota."""
+    started_at = time.monotonic()
+    plants = await dal.get_all_plants()
+    if not isinstance(plants, list):
+        # Error dict of the access layer: the previous weather is kept
+        logging.error(f"Weather not refreshed, could not get plants: {plants}")
+        return
+    cells = {} # Key= cell (lat, lng), Obj= ids of plants in the cell
+    skipped = []
     for plant in plants:
         try:
-            # Get weather data at the plant location
-            weather_url = f"{api_url}weather?lat={plant['lat']}&lon={plant['lng']}&units=metric&appid={api_key}" # type: ignore
-            async with ClientSession() as session:
-                async with session.get(weather_url) as response:
-                    if response.status == 200:
-                        weather_data = await response.json()
-                        current_weather[plant['id']] = weather_data # type: ignore
-                    else:
-                        logging.error(f"Error fetching weather data for plant {plant['id']}. Status code: {response.status}") # type: ignore
+            cell = weather_cell(plant)
+        except (TypeError, ValueError):
+            skipped.append(plant['id']) # Missing or invalid coordinates
+            continue
+        cells.setdefault(cell, []).append(plant['id'])
+    if skipped:
+        logging.warning(f"No weather for plants {skipped}: missing or invalid coordinates.")
+
+    semaphore = asyncio.Semaphore(WEATHER_CONCURRENCY)
+    await asyncio.gather(*(fetch_cell_weather(cell, plant_ids, semaphore) for cell, plant_ids in cells.items()))
+    weather_stats["cells"] = len(cells)
+    weather_stats["skipped_plants"] = len(skipped)
+    weather_stats["last_refresh_seconds"] = round(time.monotonic() - started_at, 3)
+
+    await set_light_quality({plant['id']: plant['thingy_id'] for plant in plants})
+
+
+def weather_cell(plant):
+    """Returns the grid cell of a plant: its coordinates rounded to
+    WEATHER_GRID_PRECISION decimals. Raises TypeError or ValueError if
+    coordinates are missing (None) or invalid."""
+    return (round(float(plant['lat']), WEATHER_GRID_PRECISION),
+            round(float(plant['lng']), WEATHER_GRID_PRECISION))
+
+
+async def fetch_cell_weather(cell, plant_ids, semaphore):
+    """Gets weather data at the center of a cell, for all plants in it.
+    Errors are logged: the previous weather of the plants is kept."""
+    async with semaphore:
+        await rate_limiter.acquire()
+        weather_stats["requests"] += 1
+        try:
+            params = {"lat": cell[0], "lon": cell[1], "units": "metric", "appid": api_key}
+            async with get_session().get(f"{api_url}weather", params=params) as response:
+                if response.status == 200:
+                    weather_data = await response.json()
+                    for plant_id in plant_ids:
+                        current_weather[plant_id] = weather_data
+                else:
+                    weather_stats["errors"] += 1
+                    logging.error(f"Error fetching weather data for plants {plant_ids}. Status code: {response.status}")
+        except asyncio.TimeoutError:
+            weather_stats["timeouts"] += 1
+            logging.error(f"Timeout when fetching weather data for plants {plant_ids}.")
         except Exception as e:
-            logging.error("Error when fetching weather data.")
-    
-    set_light_quality()
+            weather_stats["errors"] += 1
+            logging.error(f"Error when fetching weather data: {e}")
 
 
-def set_light_quality():
+async def set_light_quality(thingy_ids=None):
     """
     Set light quality and publish mqtt to change led color.
     # 5 levels of light quality, 0 = best, 4 = worst
@@ -50,10 +149,12 @@ def set_light_quality():
     # Level 2: Yellow (e.g., #FFFF00)
     # Level 3: Orange (e.g., #FFA500)
     # Level 4: Red (e.g., #FF0000)
+    :param thingy_ids: {plant_id: thingy_id}, plants not in it are read from the database.
     """
    
     global current_weather
     global current_light_quality
+    global light_quality_version
 
     # Set all current plant light quality and color for thingy led.
     for plant_id, weather_info in current_weather.items():
@@ -79,11 +180,15 @@ def set_light_quality():
         # update light only if status has changed since last time
         if plant_id not in current_light_quality or light_quality != current_light_quality[plant_id]:
             current_light_quality[plant_id] = light_quality
+            light_quality_version += 1
 
-            thingy_id = get_plant(plant_id)['thingy_id']
-            # Publish mqtt to change color of current thingy
+            if thingy_ids and plant_id in thingy_ids:
+                thingy_id = thingy_ids[plant_id]
+            else:
+                thingy_id = (await dal.get_plant(plant_id))['thingy_id']
+            # Publish mqtt to change color of current thingy (blocking: connects to the broker)
             logging.info(f"Changing light quality status color for {thingy_id}, plant {plant_id}")
-            publish_led_color(thingy_id, color)
+            await asyncio.get_running_loop().run_in_executor(None, publish_led_color, thingy_id, color)
 
 
 def get_current_light_quality(plant_id):
@@ -96,6 +201,16 @@ def get_current_light_quality(plant_id):
         return 2
     
 
+def get_light_quality_version():
+    """Returns a number changing each time a plant light quality changes."""
+    return light_quality_version
+
+
+def get_weather_stats():
+    """Returns weather requests counters, for monitoring."""
+    return {**weather_stats, "plants": len(current_weather)}
+
+
 def get_current_station_weather(plant_id):
     """Returns plant current weather (all informations).
     :param: plant_id"""